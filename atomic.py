@@ -0,0 +1,29 @@
+"""
+Replacing files so that a crash or power cut never leaves a partial one.
+"""
+
+import os
+
+def atomic_write(path, data, tmppath=None, times=None):
+    """Replace the file at path with data (str or bytes).
+
+    The data is written to tmppath (by default path + '.tmp') and flushed to
+    the disk before it is renamed over path, and the rename is flushed to the
+    disk too. So after a crash path holds either the old or the new data in
+    full, and once we return it holds the new data. If given, times is the
+    (atime, mtime) to give the file, as for os.utime().
+    """
+    if tmppath is None:
+        tmppath = path + '.tmp'
+    with open(tmppath, 'wb' if isinstance(data, bytes) else 'w') as f:
+        f.write(data)
+        f.flush()
+        if times is not None:
+            os.utime(f.fileno(), times)
+        os.fsync(f.fileno())
+    os.replace(tmppath, path)
+    directory = os.open(os.path.dirname(path) or '.', os.O_RDONLY)
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark picture selection, directory scanning and rendering without a Pi or a monitor.
+
+Synthetic libraries of filenames are generated in memory (no files are
+written), and rendering uses SDL's dummy video driver. For example:
+
+    python benchmark.py --sizes 10000 100000 1000000 --picks 2000
+"""
+
+import argparse
+import datetime
+import os
+import random
+import statistics
+import tempfile
+import time
+import tracemalloc
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
+from index import group_by_day
+from library import PictureLibrary
+
+def synthetic_library(size, years=15, seed=0):
+    """Return size picture filenames spread over years, clustered by day like a real library.
+
+    Most days have a few pictures, some days (trips, parties) have dozens or
+    hundreds, and about 1% of the pictures have no date in their name.
+    """
+    rng = random.Random(seed)
+    start = datetime.datetime(2024 - years, 1, 1)
+    names = []
+    while len(names) < size:
+        day = start + datetime.timedelta(days=rng.randrange(365 * years))
+        # A heavy-tailed number of pictures on the day
+        count = min(int(rng.paretovariate(1.2)), 500)
+        for _ in range(count):
+            taken = day + datetime.timedelta(seconds=rng.randrange(24 * 60 * 60))
+            names.append(f"{taken:%Y%m%d%H%M%S}-{rng.getrandbits(64):016x}.jpg")
+    names = names[:size]
+    for i in range(0, size, 100):
+        names[i] = f"IMG_{i:06d}.jpg"
+    rng.shuffle(names)
+    return names
+
+def timed(function, *args):
+    """Call function, returning (seconds, result)."""
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+def report(name, seconds):
+    """Print the latency percentiles of a list of timings."""
+    seconds = sorted(seconds)
+    if len(seconds) > 1:
+        q = statistics.quantiles(seconds, n=100, method='inclusive')
+        p50, p90, p99 = q[49], q[89], q[98]
+    else:
+        p50 = p90 = p99 = seconds[0]
+    print(f"  {name:<24} n={len(seconds):<6} p50={p50*1e3:9.3f} ms  p90={p90*1e3:9.3f} ms  "
+          f"p99={p99*1e3:9.3f} ms  max={seconds[-1]*1e3:9.3f} ms")
+
+def report_memory(name, function, *args, **kwargs):
+    """Print the peak memory allocated while calling function."""
+    tracemalloc.start()
+    result = function(*args, **kwargs)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"  {name:<24} peak memory {peak/2**20:.1f} MB")
+    return result
+
+
+class SyntheticFiles:
+    """A watcher (see watcher.py) over a fixed list of filenames that never change."""
+
+    def __init__(self, files):
+        self.files = set(files)
+
+    def changes(self):
+        return set(), set()
+
+    def close(self):
+        pass
+
+
+def benchmark_library(size, picks, repeat):
+    print(f"Library of {size} pictures")
+    files = synthetic_library(size)
+    with tempfile.TemporaryDirectory() as state:
+        library = report_memory('load', PictureLibrary, state,
+                                os.path.join(state, 'journal.txt'), os.path.join(state, 'deleted.txt'),
+                                watcher=SyntheticFiles(files), random=random.Random(1))
+
+        report('scan', [timed(library.rescan)[0] for _ in range(repeat)])
+        report('group_by_day', [timed(group_by_day, files)[0] for _ in range(repeat)])
+        report('reset weights', [timed(library.reweight)[0] for _ in range(repeat)])
+
+        picks = min(picks, size)
+        report('pick', [timed(library.pick)[0] for _ in range(picks)])
+        report('neighbors', [timed(library.neighbors, filename)[0] for filename in files[:picks]])
+        library.close()
+
+def benchmark_render(size, frames):
+    import pygame
+    import pygame.freetype
+    from render import Renderer, fit
+
+    print(f"Rendering at {size[0]}x{size[1]}")
+    pygame.display.init()
+    pygame.freetype.init()
+    screen = pygame.display.set_mode(size)
+    font = pygame.freetype.SysFont('freesans', 120)
+    renderer = Renderer(screen, font)
+
+    rng = random.Random(2)
+    images = []
+    for width, height in ((1920, 1080), (1080, 1920), (1440, 1080)):
+        image = pygame.Surface((width, height)).convert()
+        image.fill((rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+        images.append(image)
+
+    report('fit', [timed(fit, images[i % len(images)], size)[0] for i in range(frames)])
+    fitted = [fit(image, size) for image in images]
+    report('show (new picture)', [timed(renderer.show, fitted[i % len(fitted)], f"{i:08d}")[0]
+                                  for i in range(frames)])
+    report('show (refresh)', [timed(renderer.show, fitted[0], 'refresh')[0] for i in range(frames)])
+
+    def tick():
+        # Force the clock to change every time
+        renderer._clock = None
+        renderer.update_clock()
+    report('update_clock', [timed(tick)[0] for i in range(frames)])
+
+    seconds = []
+    for i in range(frames):
+        # Start a long crossfade to a new picture and time its next frame
+        renderer.show(fitted[i % 2], 'fade', transition_ms=60_000)
+        seconds.append(timed(renderer.transition_step)[0])
+    report('crossfade frame', seconds)
+    pygame.quit()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000],
+                        help='numbers of pictures in the synthetic libraries')
+    parser.add_argument('--picks', type=int, default=2000, help='random picks to time per library')
+    parser.add_argument('--repeat', type=int, default=5, help='times to repeat the scan and weight rebuild')
+    parser.add_argument('--frames', type=int, default=50, help='frames to render')
+    parser.add_argument('--screen', type=int, nargs=2, default=[1920, 1080], help='screen size to render at')
+    parser.add_argument('--no-render', action='store_true', help='skip the rendering benchmarks')
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        benchmark_library(size, args.picks, args.repeat)
+    if not args.no_render:
+        benchmark_render(tuple(args.screen), args.frames)
@@ -0,0 +1,93 @@
+"""
+Least-recently-used caches of decoded pictures with a memory budget.
+"""
+
+import threading
+from collections import OrderedDict
+
+def surface_bytes(surface):
+    """The number of bytes of pixel data in a pygame surface."""
+    return surface.get_pitch() * surface.get_height()
+
+class LRUCache:
+    """Values by key, dropping the least recently used ones once their total size is over budget bytes.
+
+    The cache is safe to use from several threads. ``hits`` and ``misses``
+    count the lookups done with ``get()``.
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self._lock = threading.Lock()
+        # key -> (value, size), least recently used first
+        self._entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __repr__(self):
+        return (f'{type(self).__name__}({len(self)} pictures, {self.bytes/2**20:.1f}/{self.budget/2**20:.1f} MB, '
+                f'{self.hits} hits, {self.misses} misses)')
+
+    def get(self, key):
+        """Return the cached value for key, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def _put(self, key, value, size):
+        """Add value as the most recently used, returning the (key, value) pairs dropped to make room."""
+        dropped = []
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self._entries[key] = (value, size)
+            self.bytes += size
+            # Always keep the newest value, even if it is over budget by itself
+            while self.bytes > self.budget and len(self._entries) > 1:
+                old_key, (old_value, old_size) = self._entries.popitem(last=False)
+                self.bytes -= old_size
+                dropped.append((old_key, old_value))
+        return dropped
+
+    def touch(self, key):
+        """Mark key as recently used without counting a lookup. Return whether it is cached."""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return True
+            return False
+
+    def discard(self, key):
+        """Drop key from the cache if it is there, returning whether it was."""
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            return old is not None
+
+
+class SurfaceCache(LRUCache):
+    """Cache decoded pictures by filename, dropping the least recently used
+    pictures once their total size is over budget bytes.
+    """
+
+    def __init__(self, budget, sizeof=surface_bytes):
+        super().__init__(budget)
+        self._sizeof = sizeof
+
+    def put(self, filename, surface):
+        """Add surface to the cache as the most recently used picture."""
+        self._put(filename, surface, self._sizeof(surface))
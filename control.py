@@ -0,0 +1,84 @@
+"""
+A local control socket, so scripts can drive the picture frame without a keyboard.
+"""
+
+import asyncio
+import json
+import os
+import threading
+
+class ControlServer:
+    """Accept commands on a Unix domain socket and hand them to the event loop.
+
+    Each line a client sends is a batch of commands separated by ``;``, e.g.
+    ``next; format 2``. ``submit(commands)`` is called with the list of
+    commands (each a list of words) from the server's thread, and returns a
+    concurrent.futures.Future of the list of replies, one per command. The
+    replies are sent back as one line of JSON.
+    """
+
+    def __init__(self, path, submit):
+        self.path = path
+        self._submit = submit
+        self._loop = None
+        self._server = None
+        self._error = None
+        self._started = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='control', daemon=True)
+
+    def start(self):
+        """Start serving on a background thread, raising OSError if we can't."""
+        self._thread.start()
+        self._started.wait()
+        if self._error is not None:
+            raise self._error
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        try:
+            self._loop.run_until_complete(self._start_server())
+        except OSError as e:
+            self._error = e
+            return
+        finally:
+            self._started.set()
+        self._loop.run_forever()
+
+    async def _start_server(self):
+        # A socket left over from before is in the way
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        self._server = await asyncio.start_unix_server(self._client, path=self.path)
+        os.chmod(self.path, 0o600)
+
+    async def _client(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                commands = [command.split() for command in line.decode(errors='replace').split(';')]
+                commands = [command for command in commands if command]
+                if not commands:
+                    continue
+                replies = await asyncio.wrap_future(self._submit(commands))
+                writer.write(json.dumps(replies).encode() + b'\n')
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    def close(self):
+        """Stop serving and remove the socket."""
+        if self._loop is None:
+            return
+        if self._server is not None:
+            self._loop.call_soon_threadsafe(self._server.close)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,63 @@
+"""
+The pictures that should never be shown again.
+"""
+
+import os
+
+from atomic import atomic_write
+
+class DeletedPictures:
+    """A set of deleted picture filenames, saved one per line in a file.
+
+    Deleting a picture appends a line to the file. The file is rewritten
+    without duplicates when it is loaded and when a deletion is undone.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # Used as an ordered set, so undo() can restore the most recent deletion
+        self._names = {}
+        lines = []
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                lines = f.read().splitlines()
+            self._names = dict.fromkeys(name for name in lines if name)
+        if len(lines) != len(self._names):
+            self._rewrite()
+        self._file = open(path, 'a')
+
+    def __contains__(self, filename):
+        return filename in self._names
+
+    def __len__(self):
+        return len(self._names)
+
+    def __iter__(self):
+        return iter(self._names)
+
+    def add(self, filename):
+        """Mark filename as deleted."""
+        if filename in self._names:
+            return
+        self._names[filename] = None
+        self._file.write(filename + '\n')
+        self._file.flush()
+
+    def undo(self):
+        """Restore the most recently deleted picture, returning its filename (or None)."""
+        if not self._names:
+            return None
+        filename = next(reversed(self._names))
+        del self._names[filename]
+        self._rewrite()
+        return filename
+
+    def _rewrite(self):
+        atomic_write(self.path, ''.join(name + '\n' for name in self._names))
+        # Keep appending to the new file
+        if hasattr(self, '_file'):
+            self._file.close()
+            self._file = open(self.path, 'a')
+
+    def close(self):
+        self._file.close()
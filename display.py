@@ -1,6 +1,22 @@
 from abc import ABC, abstractmethod
+import logging
+import queue
+import threading
+import time
+
+# The log of picture.py
+logger = logging.getLogger('pictures')
 
 class Display(ABC):
+    """A way of turning the display on and off.
+
+    Subclasses implement the blocking ``sleep()``, ``wake()`` and ``on()``,
+    which may shell out to slow tools. After ``start()``, the ``*_async``
+    methods run those on a background thread instead, and ``is_on()`` answers
+    from a cached state that the background thread refreshes once it is older
+    than ``max_age`` seconds. If ``stats`` (a stats.Stats) is given, how long
+    the background commands take is recorded in it.
+    """
 
     @abstractmethod
     def sleep(self):
@@ -24,4 +40,60 @@ class Display(ABC):
     @staticmethod
     @abstractmethod
     def active(self):
-        ...
\ No newline at end of file
+        ...
+
+    def start(self, max_age=60, stats=None):
+        """Check the display state and start the background thread for the async methods."""
+        self.max_age = max_age
+        self.stats = stats
+        self._state = self.on(check=True)
+        self._checked = time.monotonic()
+        self._refreshing = False
+        self._commands = queue.Queue()
+        threading.Thread(target=self._run, name='display', daemon=True).start()
+        return self._state
+
+    def is_on(self):
+        """Return whether the display is on, without waiting on the display.
+
+        If the cached state is stale, a refresh is started in the background.
+        """
+        if not self._refreshing and time.monotonic() - self._checked > self.max_age:
+            self._refreshing = True
+            self._commands.put((None, None))
+        return self._state
+
+    def sleep_async(self, callback=None):
+        """Turn off the display in the background, then call callback(on) from the background thread."""
+        # Assume it worked until we know better, so we don't try to sleep again
+        self._state = False
+        self._commands.put((self.sleep, callback))
+
+    def wake_async(self, callback=None):
+        """Turn on the display in the background, then call callback(on) from the background thread."""
+        self._state = True
+        self._commands.put((self.wake, callback))
+
+    def _run(self):
+        while True:
+            command, callback = self._commands.get()
+            try:
+                if command is not None:
+                    start = time.perf_counter()
+                    command()
+                    self._record(f"display {command.__name__}", start)
+                start = time.perf_counter()
+                self._state = self.on(check=True)
+                self._record("display on", start)
+            except Exception as e:
+                logger.warning(f"Display command failed: {e!r}")
+            # Even after a failure, wait for the state to go stale again before retrying
+            self._checked = time.monotonic()
+            if command is None:
+                self._refreshing = False
+            if callback is not None:
+                callback(self._state)
+
+    def _record(self, name, start):
+        if self.stats is not None:
+            self.stats.record(name, time.perf_counter() - start)
@@ -0,0 +1,265 @@
+"""
+Finding pictures that look the same (the same photo exported twice, burst shots), by perceptual hash.
+
+Run this to hash the pictures that are not in the index yet, using all of the cores:
+
+    python duplicates.py [directory ...]
+"""
+
+import json
+import os
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from atomic import atomic_write
+from index import sort_key
+
+DUPLICATES_VERSION = 1
+
+# How many of the 64 bits of two hashes can differ for the pictures to count as the same
+RADIUS = 4
+
+def dhash(image):
+    """Return the 64-bit difference hash of a PIL image.
+
+    The picture is shrunk to 9x8 grays, and each bit says whether a pixel is
+    brighter than the one to its right, so the hash survives resizing,
+    recompression and small changes in brightness.
+    """
+    from PIL import Image
+    pixels = image.convert('L').resize((9, 8), Image.BILINEAR).tobytes()
+    hash = 0
+    for row in range(8):
+        for col in range(8):
+            hash = hash << 1 | (pixels[row*9 + col] > pixels[row*9 + col + 1])
+    return hash
+
+def file_dhash(path):
+    """Return the difference hash of the picture at path, or None if it can't be read."""
+    from PIL import Image
+    try:
+        with Image.open(path) as image:
+            # Let the JPEG decoder scale down by up to 8, which is most of the work saved
+            image.draft('L', (64, 64))
+            return dhash(image)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+
+def hamming(a, b):
+    """The number of bits that differ between two hashes."""
+    return bin(a ^ b).count('1')
+
+class HashIndex:
+    """Names by hash, for finding hashes that differ in at most radius bits.
+
+    This uses multi-index hashing: the 64 bits are split into radius+1 parts,
+    and two hashes within radius bits of each other must have at least one
+    part exactly the same. So we only compare against the hashes sharing a
+    part, found with one dict lookup per part.
+    """
+
+    def __init__(self, radius=RADIUS):
+        self.radius = radius
+        parts = radius + 1
+        # The (shift, mask) of each part
+        self._parts = []
+        start = 0
+        for i in range(parts):
+            bits = (64 - start) // (parts - i)
+            self._parts.append((start, (1 << bits) - 1))
+            start += bits
+        self._tables = [{} for _ in self._parts]
+
+    def _keys(self, hash):
+        return [(hash >> shift) & mask for shift, mask in self._parts]
+
+    def add(self, hash, name):
+        for table, key in zip(self._tables, self._keys(hash)):
+            table.setdefault(key, {})[name] = hash
+
+    def remove(self, hash, name):
+        for table, key in zip(self._tables, self._keys(hash)):
+            names = table.get(key)
+            if names is not None:
+                names.pop(name, None)
+                if not names:
+                    del table[key]
+
+    def find(self, hash):
+        """Return {name: distance} for the names with a hash within radius bits of hash."""
+        found = {}
+        for table, key in zip(self._tables, self._keys(hash)):
+            for name, other in table.get(key, {}).items():
+                if name not in found:
+                    distance = hamming(hash, other)
+                    if distance <= self.radius:
+                        found[name] = distance
+        return found
+
+
+class DuplicateIndex:
+    """The hash of each picture, and which pictures are near-duplicates of another.
+
+    Pictures are keyed by name, with the mtime and size of the file they were
+    hashed from, so a file that changes is hashed again. Of a group of
+    near-duplicates, the first by sort_key (the oldest) is the original and
+    the others map to it in ``duplicate_of``. The index is saved as JSON at
+    path, and can be reloaded when someone else (like the downloader) saved
+    it, see ``changed()``. Methods can be called from any thread.
+    """
+
+    def __init__(self, path, radius=RADIUS):
+        self.path = path
+        self.radius = radius
+        self._lock = threading.Lock()
+        # name: [mtime, size, hash]
+        self.entries = {}
+        self.duplicate_of = {}
+        self._hashes = HashIndex(radius)
+        self._mtime = None
+        try:
+            self._mtime = os.stat(path).st_mtime
+            with open(path, 'r') as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return
+        if index.get('version') != DUPLICATES_VERSION:
+            return
+        self.entries = index['entries']
+        for name, (mtime, size, hash) in self.entries.items():
+            self._hashes.add(hash, name)
+        if index.get('radius') == radius:
+            self.duplicate_of = index['duplicate_of']
+        else:
+            self._find_duplicates()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _find_duplicates(self):
+        """Work out duplicate_of from scratch."""
+        self.duplicate_of = {}
+        for name in sorted(self.entries, key=sort_key):
+            matches = self._hashes.find(self.entries[name][2])
+            earlier = [match for match in matches if sort_key(match) < sort_key(name)]
+            if earlier:
+                self.duplicate_of[name] = min(earlier, key=sort_key)
+
+    def stale(self, name, mtime, size):
+        """Whether name needs to be hashed (again) for a file with mtime and size."""
+        entry = self.entries.get(name)
+        return entry is None or entry[0] != mtime or entry[1] != size
+
+    def claim(self, name, hash, mtime=None, size=None):
+        """Index name unless it is a near-duplicate, returning the original it duplicates (or None).
+
+        Checking and adding in one go means that of two near-duplicates claimed
+        at the same time, only one gets in.
+        """
+        with self._lock:
+            matches = self._hashes.find(hash)
+            # Claiming a picture we already have is fine
+            matches.pop(name, None)
+            if not matches:
+                self._add(name, hash, mtime, size)
+                return None
+            original = min(matches, key=sort_key)
+            return self.duplicate_of.get(original, original)
+
+    def add(self, name, hash, mtime, size):
+        """Index the hash of the picture name, updating which pictures are duplicates."""
+        with self._lock:
+            self._add(name, hash, mtime, size)
+
+    def _add(self, name, hash, mtime, size):
+        if name in self.entries:
+            self._hashes.remove(self.entries[name][2], name)
+        self.entries[name] = [mtime, size, hash]
+        self._hashes.add(hash, name)
+        self.duplicate_of.pop(name, None)
+        for match in self._hashes.find(hash):
+            if match == name:
+                continue
+            if sort_key(match) < sort_key(name):
+                if name not in self.duplicate_of or sort_key(match) < sort_key(self.duplicate_of[name]):
+                    self.duplicate_of[name] = match
+            elif match not in self.duplicate_of or sort_key(name) < sort_key(self.duplicate_of[match]):
+                self.duplicate_of[match] = name
+
+    def remove(self, name):
+        """Forget the picture name (e.g., one that was claimed but could not be written)."""
+        with self._lock:
+            entry = self.entries.pop(name, None)
+            if entry is None:
+                return
+            self._hashes.remove(entry[2], name)
+            self.duplicate_of.pop(name, None)
+            if name in self.duplicate_of.values():
+                self._find_duplicates()
+
+    def prune(self, names):
+        """Forget the pictures that are not in names."""
+        with self._lock:
+            names = set(names)
+            for name in [name for name in self.entries if name not in names]:
+                self._hashes.remove(self.entries.pop(name)[2], name)
+            self._find_duplicates()
+
+    def changed(self):
+        """Whether the index file was saved (by someone else) since we read it or last asked."""
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return False
+        if mtime == self._mtime:
+            return False
+        self._mtime = mtime
+        return True
+
+    def save(self):
+        """Write the index."""
+        with self._lock:
+            index = {
+                'version': DUPLICATES_VERSION,
+                'radius': self.radius,
+                'entries': self.entries,
+                'duplicate_of': self.duplicate_of,
+            }
+            atomic_write(self.path, json.dumps(index, separators=(',', ':')))
+            self._mtime = os.stat(self.path).st_mtime
+
+
+def update(duplicates, watcher, workers=None):
+    """Hash the pictures watcher knows of that are not in duplicates yet, on a process pool.
+
+    Returns the number of pictures hashed. Pictures that are gone are forgotten.
+    """
+    from library import is_picture
+    names = [name for name in watcher.files if is_picture(name)]
+    todo = []
+    for name in names:
+        st = os.stat(watcher.path(name))
+        if duplicates.stale(name, st.st_mtime, st.st_size):
+            todo.append((name, st.st_mtime, st.st_size))
+    duplicates.prune(names)
+    with ProcessPoolExecutor(workers) as executor:
+        paths = (watcher.path(name) for name, _, _ in todo)
+        for (name, mtime, size), hash in zip(todo, executor.map(file_dhash, paths, chunksize=16)):
+            if hash is not None:
+                duplicates.add(name, hash, mtime, size)
+    return len(todo)
+
+def duplicates_file(directory):
+    """Where the duplicate index of a pictures directory is kept (hidden, so it is not taken for a picture)."""
+    return os.path.join(directory, '.picture_duplicates.json')
+
+if __name__ == '__main__':
+    from watcher import watch_library
+    directories = sys.argv[1:] or ['/home/pi/Export1080p/']
+    duplicates = DuplicateIndex(duplicates_file(directories[0]))
+    watcher = watch_library(directories)
+    hashed = update(duplicates, watcher)
+    duplicates.save()
+    watcher.close()
+    print(f"Hashed {hashed} pictures: {len(duplicates.duplicate_of)} of {len(duplicates)} are near-duplicates")
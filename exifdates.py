@@ -0,0 +1,197 @@
+"""
+Dates of pictures whose names don't start with one, read from their EXIF data in the background.
+"""
+
+import json
+import os
+import struct
+import threading
+import time
+from collections import deque
+
+from atomic import atomic_write
+from weights import picweek
+
+# EXIF tags holding dates, most trusted first
+DATE_TIME_ORIGINAL = 0x9003
+DATE_TIME_DIGITIZED = 0x9004
+DATE_TIME = 0x0132
+EXIF_IFD = 0x8769
+
+def _read_ifd(tiff, offset, order):
+    """Return {tag: (count, value or offset bytes)} for the IFD at offset in tiff."""
+    count, = struct.unpack_from(order + 'H', tiff, offset)
+    entries = {}
+    for i in range(count):
+        tag, _, n = struct.unpack_from(order + 'HHI', tiff, offset + 2 + 12*i)
+        entries[tag] = (n, tiff[offset + 2 + 12*i + 8:offset + 2 + 12*i + 12])
+    return entries
+
+def _exif_day(tiff):
+    """Return the YYYYMMDD day the picture was taken from EXIF (TIFF) data, or None."""
+    order = {b'II': '<', b'MM': '>'}.get(tiff[:2])
+    if order is None:
+        return None
+    ifd0 = _read_ifd(tiff, struct.unpack_from(order + 'I', tiff, 4)[0], order)
+    ifds = [ifd0]
+    if EXIF_IFD in ifd0:
+        ifds.insert(0, _read_ifd(tiff, struct.unpack_from(order + 'I', ifd0[EXIF_IFD][1])[0], order))
+    for tag in (DATE_TIME_ORIGINAL, DATE_TIME_DIGITIZED, DATE_TIME):
+        for ifd in ifds:
+            if tag not in ifd:
+                continue
+            n, value = ifd[tag]
+            if n > 4:
+                offset, = struct.unpack_from(order + 'I', value)
+                value = tiff[offset:offset + n]
+            # 'YYYY:MM:DD HH:MM:SS'
+            day = value[:10].decode('ascii', errors='replace').replace(':', '')
+            if picweek(day) is not None:
+                return day
+    return None
+
+def exif_day(path, max_bytes=256 * 1024):
+    """Return the YYYYMMDD day a JPEG was taken, from its EXIF data, or None.
+
+    Only the segment headers at the start of the file (up to max_bytes) and
+    the EXIF segment itself are read, never the picture.
+    """
+    try:
+        with open(path, 'rb') as f:
+            if f.read(2) != b'\xff\xd8':
+                return None
+            while f.tell() < max_bytes:
+                header = f.read(4)
+                if len(header) < 4 or header[0] != 0xff:
+                    return None
+                marker, length = header[1], struct.unpack('>H', header[2:])[0]
+                # Start of scan: the picture itself, so there are no more headers
+                if marker == 0xda:
+                    return None
+                if marker == 0xe1:
+                    segment = f.read(length - 2)
+                    if segment.startswith(b'Exif\0\0'):
+                        return _exif_day(segment[6:])
+                else:
+                    f.seek(length - 2, os.SEEK_CUR)
+    except (OSError, struct.error, KeyError):
+        pass
+    return None
+
+class ExifDates:
+    """The days of undated pictures, read from their EXIF data on a background thread.
+
+    ``request()`` queues pictures to be read, at most files_per_second of them
+    a second so the SD card stays free for showing pictures, and ``found()``
+    returns the days read since it was last called. What we read is appended
+    to the file at path as lines of JSON, [name, mtime, size, day], so each
+    picture is only read once (pictures without an EXIF date too). The file
+    is flushed to disk every save_seconds and on ``close()``; a crash only
+    loses the last few, which are read again. Later lines for a name replace
+    earlier ones, and the file is rewritten with one line per picture when it
+    is loaded, if that makes it noticeably shorter.
+    """
+
+    def __init__(self, path, files_per_second=10, save_seconds=60):
+        self.path = path
+        self.interval = 1 / files_per_second
+        self.save_seconds = save_seconds
+        self._lock = threading.Lock()
+        # name: [mtime, size, day or None]
+        self.entries = {}
+        lines = bad = 0
+        try:
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        name, mtime, size, day = json.loads(line)
+                    except (ValueError, TypeError):
+                        # A torn last line, from a crash while writing it
+                        bad += 1
+                        continue
+                    self.entries[name] = [mtime, size, day]
+                    lines += 1
+        except OSError:
+            pass
+        if bad or lines > 2 * len(self.entries):
+            atomic_write(path, ''.join(json.dumps([name, *entry]) + '\n' for name, entry in self.entries.items()))
+        self._file = open(path, 'a')
+        self._saved = time.monotonic()
+        # (name, path) to read
+        self._queue = deque()
+        self._queued = set()
+        self._found = []
+        self._unsaved = 0
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._thread = None
+
+    @property
+    def days(self):
+        """The days we know, by picture name."""
+        with self._lock:
+            return {name: entry[2] for name, entry in self.entries.items() if entry[2] is not None}
+
+    def request(self, pictures):
+        """Queue (name, path) pairs of pictures to have their date read, unless we already know it."""
+        with self._lock:
+            for name, path in pictures:
+                if name not in self._queued:
+                    self._queued.add(name)
+                    self._queue.append((name, path))
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='exifdates', daemon=True)
+            self._thread.start()
+        self._wakeup.set()
+
+    def found(self):
+        """Return the (name, day) pairs read since the last call that changed a day (to None if it is gone)."""
+        with self._lock:
+            found, self._found = self._found, []
+        return found
+
+    def _run(self):
+        while not self._closed:
+            with self._lock:
+                item = self._queue.popleft() if self._queue else None
+            if item is None:
+                if self._unsaved and time.monotonic() - self._saved >= self.save_seconds:
+                    self.save()
+                self._wakeup.wait(self.save_seconds if self._unsaved else None)
+                self._wakeup.clear()
+                continue
+            name, path = item
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entry = self.entries.get(name)
+            if entry is not None and entry[0] == st.st_mtime and entry[1] == st.st_size:
+                continue
+            day = exif_day(path)
+            with self._lock:
+                self.entries[name] = [st.st_mtime, st.st_size, day]
+                if day != (entry[2] if entry is not None else None):
+                    self._found.append((name, day))
+            self._file.write(json.dumps([name, st.st_mtime, st.st_size, day]) + '\n')
+            self._unsaved += 1
+            if time.monotonic() - self._saved >= self.save_seconds:
+                self.save()
+            time.sleep(self.interval)
+
+    def save(self):
+        """Flush what we read to disk."""
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsaved = 0
+        self._saved = time.monotonic()
+
+    def close(self):
+        """Stop reading and save what we read."""
+        self._closed = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._unsaved:
+            self.save()
+        self._file.close()
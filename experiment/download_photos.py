@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 # Expects the following to be installed:
-# pip install google-api-python-client google-auth-httplib2 google-auth-oauthlib pillow
+# pip install google-api-python-client google-auth-httplib2 google-auth-oauthlib pillow requests
 
 import os.path
 
@@ -10,12 +10,21 @@ from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
-import tempfile
-import subprocess
+import hashlib
+import io
+import sys
 from pathlib import Path
-import shutil
-import requests
-from datetime import datetime
+import json
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from PIL import Image
+
+# duplicates.py and atomic.py are shared with the picture frame, one directory up
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from atomic import atomic_write
+from duplicates import DuplicateIndex, dhash, duplicates_file
+from fetch import Downloader
+from manifest import Manifest
 
 google_photos = None
 
@@ -50,29 +59,95 @@ def refresh_creds():
         print(err)
     return google_photos
 
-def get_items(destdir, google_photos, max_items=1000):
+def existing_filenames(destdir):
+    """Return the set of filenames in destdir, from a single listing of it."""
+    with os.scandir(destdir) as entries:
+        return {entry.name for entry in entries}
+
+def list_pages(google_photos, page_size=100):
+    """Yield the pages of media items, fetching the next page in the background while the caller works on this one."""
+    def fetch(token):
+        return google_photos.mediaItems().list(pageSize=page_size, pageToken=token).execute()
+
+    # Each page needs the token from the one before, so only one page can be fetched at a time
+    with ThreadPoolExecutor(max_workers=1) as pager:
+        future = pager.submit(fetch, None)
+        while future is not None:
+            results = future.result()
+            nextpagetoken = results.get('nextPageToken', '')
+            future = pager.submit(fetch, nextpagetoken) if nextpagetoken else None
+            # If we don't get any result, there is nothing on this page to get
+            yield results.get('mediaItems') or []
+
+def get_items(destdir, google_photos, max_items=1000, high_water=None, manifest=None, max_failures=3):
+    """Return (items, newest, complete) for the media items we don't have in destdir yet.
+
+    items are the new media items, at most max_items of them. newest is the
+    latest creation time we came across. complete is whether we looked at
+    every page we needed to (i.e., we did not stop because of max_items).
+
+    The library is listed newest first, so if high_water (the newest creation
+    time from the last complete sync) is given, we stop at the first page
+    with nothing newer than it. Items the manifest has as done are skipped,
+    even if they are not in destdir anymore, and so are items that failed
+    max_failures times in a row.
+    """
+    existing = existing_filenames(destdir)
     items = []
-    nextpagetoken = None
+    newest = high_water
     pages = 0
+    complete = True
     # The default number of media items to return at a time is 25. The maximum pageSize is 100.
-    # while nextpagetoken != '':
-    while nextpagetoken != ""  and len(items) < max_items:
+    for page in list_pages(google_photos):
+        pages += 1
         print(f"Retrieving page {pages} of photo metadata: {len(items)} items", end='\r')
-        results = google_photos.mediaItems().list(pageSize=100, pageToken=nextpagetoken).execute()
-
-        # If we don't get any result, abort since something is wrong
-        unfiltered_results = results.get('mediaItems', None)
-
-        #if unfiltered_results is None:
-        #    print('did not get any media items', results)
-        #    break
-
         # add anything new to the list of files to get
-        if unfiltered_results is not None:
-            items += [i for i in unfiltered_results if not (destdir / item_to_filename(i)).exists()]
-        nextpagetoken = results.get('nextPageToken', '')
-    print(f"Retrieved {pages} of photo metadata: {len(items)} items")
-    return items
+        for item in page:
+            filename = item_to_filename(item)
+            if filename not in existing and not (manifest is not None and finished(manifest, item, max_failures)):
+                existing.add(filename)
+                items.append(item)
+        created = [item['mediaMetadata']['creationTime'] for item in page]
+        if created and (newest is None or max(created) > newest):
+            newest = max(created)
+        if max_items is not None and len(items) >= max_items:
+            items = items[:max_items]
+            complete = False
+            break
+        if high_water is not None and created and max(created) <= high_water:
+            break
+    print(f"Retrieved {pages} pages of photo metadata: {len(items)} items")
+    return items, newest, complete
+
+def finished(manifest, item, max_failures):
+    """Whether we are done with item: it was synced, or we gave up on it after max_failures tries."""
+    return manifest.done(item['id']) or manifest.failures(item['id']) >= max_failures
+
+def next_high_water(items, newest, high_water, manifest, max_failures):
+    """Return the high-water mark for the next sync, after syncing items (from a complete listing).
+
+    That is newest if we are done with every item. Otherwise it is just below
+    the oldest item we are not done with (but never lower than high_water),
+    so the next sync lists the library back to that item and no further.
+    """
+    unfinished = [item['mediaMetadata']['creationTime'] for item in items
+                  if not finished(manifest, item, max_failures)]
+    if not unfinished:
+        return newest
+    oldest = datetime.strptime(min(unfinished), '%Y-%m-%dT%H:%M:%SZ')
+    mark = (oldest - timedelta(seconds=1)).strftime('%Y-%m-%dT%H:%M:%SZ')
+    return mark if high_water is None else max(mark, high_water)
+
+def read_sync_state(path):
+    """Return the state saved by the last sync, or an empty state."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def write_sync_state(path, state):
+    atomic_write(path, json.dumps(state))
 
 # A translation table to remove :-ZT characters
 stripchars = str.maketrans('', '', ':-ZT')
@@ -80,90 +155,163 @@ stripchars = str.maketrans('', '', ':-ZT')
 def item_to_filename(item):
     return f"{item['mediaMetadata']['creationTime'].translate(stripchars)}-{item['id'][:20]}.jpg"
 
-def process_item(tmpdir, destdir, item):
+def resize(data, size=(1920, 1080), quality=90):
+    """Shrink an encoded picture to fit in size, returning the encoded result and its hash.
+
+    The hash is the difference hash of the picture (see duplicates.py).
+    Pictures that already fit are returned as they are. JPEGs are scaled down
+    by the decoder itself (by 1/2, 1/4 or 1/8, see Image.draft()) before the
+    final resize, which is much faster than decoding them at full size.
+    """
+    with Image.open(io.BytesIO(data)) as image:
+        if image.width <= size[0] and image.height <= size[1]:
+            image.draft('L', (64, 64))
+            return data, dhash(image)
+        format = image.format
+        exif = image.info.get('exif')
+        icc_profile = image.info.get('icc_profile')
+        image.thumbnail(size, Image.LANCZOS, reducing_gap=3.0)
+        out = io.BytesIO()
+        if format == 'JPEG':
+            image.save(out, 'JPEG', quality=quality, exif=exif or b'', icc_profile=icc_profile)
+        else:
+            image.save(out, format)
+        return out.getvalue(), dhash(image)
+
+def process_item(destdir, item, resizer, downloader, manifest, duplicates):
     """
     Process one item, downloading it and resizing it as needed.
+
+    The picture is downloaded into memory with downloader (see fetch.py) and
+    resized on the resizer process pool, then written to destdir in one go.
+    It is written to a hidden file that is flushed to disk and renamed into
+    place (see atomic.py), so a partial picture is never shown or recorded as
+    done. If the download fails, what we got is kept in a
+    hidden .download file, and the next try carries on from there.
+
+    A picture that is a near-duplicate of one we have (see duplicates.py) is
+    not written, and is recorded as a duplicate in the manifest. Otherwise,
+    once the picture is in place, it is recorded as done in the manifest.
     """
     filename = item_to_filename(item)
-    tmppath = tmpdir / filename
     destpath = destdir / filename
+    partpath = destdir / f".{filename}.part"
 
     url = item['baseUrl']+'=d'
-    if not destpath.exists():
-        response = requests.get(url, stream=True)
-
-        # If it is a FORBIDDEN error, refresh creds and try again
-        if response.status_code == 403:
-            refresh_creds()
-            response = requests.get(url, stream=True)
-
-        if response.status_code != 200:
-            # Raise an exception if the HTTP status code indicates an error
-            raise Exception(f"Failed to download image {item}. Status code: {response.status_code}")
-
-        with open(tmppath, 'wb') as out_file:
-            shutil.copyfileobj(response.raw, out_file)
-        subprocess.check_output(f"mogrify -resize '1920x1080>' '{tmppath}'", shell=True)
-
+    if destpath.exists():
+        manifest.record(item['id'], filename=filename, size=destpath.stat().st_size, sha256=None, status='done')
+    else:
+        data = downloader.get(url, partial=destdir / f".{filename}.download")
+        data, hash = resizer.submit(resize, data).result()
         # Change the file modification/access time in python - even if the file does not have exif time metadata
         #creation = datetime.fromisoformat(item['mediaMetadata']['creationTime']).timestamp()
         creation = datetime.strptime(item['mediaMetadata']['creationTime'], '%Y-%m-%dT%H:%M:%SZ').timestamp()
 
-        os.utime(tmppath, (creation, creation))
-
         # exif changing the access time
-        # subprocess.check_output(f"exiftool '-FileCreateDate<DateTimeOriginal' '-FileModifyDate<DateTimeOriginal' '{tmppath}'", shell=True)
-
-
-        # with python 3.11, we can just use the Path entries directly.
-        shutil.move(str(tmppath), str(destpath))
+        # subprocess.check_output(f"exiftool '-FileCreateDate<DateTimeOriginal' '-FileModifyDate<DateTimeOriginal' '{partpath}'", shell=True)
+
+        original = duplicates.claim(filename, hash)
+        if original is not None:
+            manifest.record(item['id'], filename=filename, size=len(data), sha256=None,
+                            status='duplicate', duplicate_of=original)
+            return None
+        # On the disk before the manifest says it is done
+        try:
+            atomic_write(destpath, data, tmppath=partpath, times=(creation, creation))
+        except BaseException:
+            # Don't keep the hash of a picture we don't have, or its near-duplicates would never be synced
+            duplicates.remove(filename)
+            raise
+        st = destpath.stat()
+        duplicates.add(filename, hash, st.st_mtime, st.st_size)
+        manifest.record(item['id'], filename=filename, size=len(data),
+                        sha256=hashlib.sha256(data).hexdigest(), status='done')
 
     return destpath
 
 
 
 
-import threading
+import argparse
 import time
-import sys
 
-def timeout():
-    """Function to stop the program after 10 minutes"""
-    time.sleep(60)  # 600 seconds = 10 minutes
-    print("Time is up! Exiting the program.")
-    sys.exit()  # Exit the program
+def sync(items, destdir, resizer, downloader, manifest, duplicates, workers, time_budget):
+    """Download items until they are all done or time_budget seconds are up, returning how many are done.
 
+    Items are started one at a time as workers free up, so when time is up we
+    only wait for the ones in flight. Items that fail are recorded as failed
+    in the manifest and tried again next time.
+    """
+    deadline = time.monotonic() + time_budget
+    remaining = iter(items)
+    running = {}
+    completed = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            while len(running) < workers and time.monotonic() < deadline:
+                item = next(remaining, None)
+                if item is None:
+                    break
+                running[executor.submit(process_item, destdir, item, resizer, downloader, manifest,
+                                         duplicates)] = item
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                item = running.pop(future)
+                try:
+                    future.result()
+                    completed += 1
+                except Exception as e:
+                    print(f"Failed to get {item_to_filename(item)}: {e!r}")
+                    manifest.record(item['id'], filename=item_to_filename(item), size=None, sha256=None,
+                                    status='failed', error=repr(e), failures=manifest.failures(item['id']) + 1)
+                print(f"Completed {completed}/{len(items)}", end='\r')
+    print(f"Completed {completed}/{len(items)}")
+    return completed
 
 
 if __name__ == "__main__":
-
-    # Start the timer thread
-    # timer_thread = threading.Thread(target=timeout)
-    # timer_thread.daemon = True  # Daemon threads exit when the program does
-    # timer_thread.start()
-
-
+    parser = argparse.ArgumentParser(description='Download new pictures from Google Photos')
+    parser.add_argument('--full', action='store_true',
+                        help='look through the whole library, not just what is newer than the last sync')
+    parser.add_argument('--max-rate', type=float, help='the most KB per second to download at')
+    parser.add_argument('--time-budget', type=float, default=600,
+                        help='seconds to spend downloading; what is left is picked up by the next run')
+    parser.add_argument('--max-items', type=int, help='the most new pictures to look for')
+    parser.add_argument('--max-failures', type=int, default=3,
+                        help='give up on a picture after it failed this many syncs in a row')
+    args = parser.parse_args()
 
     os.chdir(Path(__file__).resolve().parent)
-    with tempfile.TemporaryDirectory() as tmpdirname:
-        print('Downloading to', tmpdirname)
-        tmpdir = Path(tmpdirname)
-
+    # Resize pictures on all of the cores
+    with ProcessPoolExecutor() as resizer:
+        # Start the resize processes now, before there are other threads around when they fork
+        resizer.submit(int).result()
         destdir = Path('/home/pi/Export1080p')
-        max_items = 200
+        # What we have synced so far, item by item
+        manifest = Manifest('sync_manifest.jsonl')
+        # The hashes of the pictures we have, so we don't download near-duplicates of them
+        duplicates = DuplicateIndex(duplicates_file(str(destdir)))
+        # The newest creation time of the last sync that got everything up to then
+        state = read_sync_state('sync_state.json')
+        high_water = None if args.full else state.get('high_water')
         google_photos = refresh_creds()
-        items = get_items(destdir, google_photos, max_items)
-        
-        from concurrent.futures import ThreadPoolExecutor, as_completed
-        
+        items, newest, complete = get_items(destdir, google_photos, args.max_items, high_water, manifest,
+                                            args.max_failures)
+
         # specify the number of worker threads you want to use
         max_workers = 3
-        # create a ThreadPoolExecutor
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            futures = {executor.submit(process_item, tmpdir, destdir, item) for item in items}
-            total = len(futures)
-            completed = 0
-            for future in as_completed(futures):
-                completed += 1
-                print(f"Completed {completed}/{total}", end='\r')
-                future.result()
+        # If a download gets a FORBIDDEN error, refresh creds and try again
+        downloader = Downloader(refresh=refresh_creds, pool_size=max_workers,
+                                bytes_per_second=args.max_rate and args.max_rate * 1024)
+        sync(items, destdir, resizer, downloader, manifest, duplicates, max_workers, args.time_budget)
+        duplicates.save()
+        manifest.compact()
+        manifest.close()
+
+        # Next time we can stop once we get back to what we are done with
+        if complete:
+            mark = next_high_water(items, newest, high_water, manifest, args.max_failures)
+            if mark is not None and mark != high_water:
+                write_sync_state('sync_state.json', dict(state, high_water=mark))
@@ -0,0 +1,136 @@
+"""
+Download files over keep-alive connections, with retries, resuming and a bandwidth cap.
+"""
+
+import os
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Statuses worth trying again after a while
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+class RateLimiter:
+    """Limit the bytes per second shared by all threads (a token bucket allowing bursts of one second)."""
+
+    def __init__(self, bytes_per_second):
+        self.rate = bytes_per_second
+        self._lock = threading.Lock()
+        self._tokens = bytes_per_second
+        self._last = time.monotonic()
+
+    def consume(self, amount):
+        """Account for amount bytes, sleeping for as long as it takes to stay under the rate."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.rate, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= amount
+            wait = -self._tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+class Downloader:
+    """Download URLs into memory from several threads.
+
+    All threads share one requests.Session, so connections are kept alive and
+    reused. Connection errors and the statuses in RETRY_STATUSES are retried
+    with exponential backoff. A transfer that breaks off is picked up where it
+    stopped with an HTTP Range request, and what we have is saved in the
+    partial file when we give up, so the next run can resume from it.
+
+    A 403 calls refresh() (e.g., to get new credentials) and tries again. If
+    several threads get a 403 at the same time, only one of them refreshes.
+    If bytes_per_second is given, all downloads together stay under it.
+    """
+
+    def __init__(self, refresh=None, retries=4, backoff=1.0, bytes_per_second=None, pool_size=10,
+                 chunk_size=64 * 1024, timeout=(10, 60)):
+        self.refresh = refresh
+        self.retries = retries
+        self.backoff = backoff
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.limiter = RateLimiter(bytes_per_second) if bytes_per_second else None
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._refresh_lock = threading.Lock()
+        # Counts refreshes, so a thread can tell if someone refreshed since its request failed
+        self._refreshes = 0
+
+    def _refresh(self, seen):
+        """Refresh, unless someone already did since we saw seen refreshes."""
+        with self._refresh_lock:
+            if self._refreshes == seen and self.refresh is not None:
+                self.refresh()
+                self._refreshes += 1
+
+    def _wait(self, attempt):
+        # Exponential backoff, with some jitter so threads don't retry in lockstep
+        time.sleep(self.backoff * 2**attempt * random.uniform(0.5, 1.5))
+
+    def get(self, url, partial=None):
+        """Return the body of url as bytes.
+
+        If the partial file exists, only the rest of the body is downloaded.
+        If the download fails, what we got is saved in partial before raising.
+        """
+        data = bytearray()
+        if partial is not None and os.path.exists(partial):
+            with open(partial, 'rb') as f:
+                data += f.read()
+        try:
+            self._get(url, data)
+        except BaseException:
+            if partial is not None and data:
+                with open(partial, 'wb') as f:
+                    f.write(data)
+            raise
+        if partial is not None and os.path.exists(partial):
+            os.remove(partial)
+        return bytes(data)
+
+    def _get(self, url, data):
+        """Download url into data, starting from what is already in data."""
+        attempt = 0
+        refreshed = False
+        while True:
+            seen = self._refreshes
+            headers = {'Range': f'bytes={len(data)}-'} if data else {}
+            try:
+                with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as response:
+                    if response.status_code == 403 and not refreshed:
+                        refreshed = True
+                        self._refresh(seen)
+                        continue
+                    if response.status_code == 416:
+                        # We already have everything, or the file changed: start over
+                        data.clear()
+                        raise requests.HTTPError(f"Range not satisfiable for {url}", response=response)
+                    if response.status_code in RETRY_STATUSES:
+                        raise requests.HTTPError(f"Status code {response.status_code} for {url}", response=response)
+                    if response.status_code not in (200, 206):
+                        raise Exception(f"Failed to download {url}. Status code: {response.status_code}")
+                    if response.status_code == 200:
+                        # The server sent the whole thing
+                        data.clear()
+                    elif not response.headers.get('Content-Range', '').startswith(f'bytes {len(data)}-'):
+                        data.clear()
+                        raise requests.HTTPError(f"Unexpected Content-Range for {url}", response=response)
+                    for chunk in response.iter_content(self.chunk_size):
+                        data += chunk
+                        if self.limiter is not None:
+                            self.limiter.consume(len(chunk))
+                    return
+            except (requests.ConnectionError, requests.Timeout, requests.HTTPError,
+                    requests.exceptions.ChunkedEncodingError):
+                if attempt >= self.retries:
+                    raise
+                self._wait(attempt)
+                attempt += 1
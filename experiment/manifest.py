@@ -0,0 +1,89 @@
+"""
+A durable record of what has been synced, so an interrupted sync can pick up where it left off.
+"""
+
+import json
+import os
+import threading
+
+from atomic import atomic_write
+
+class Manifest:
+    """What we know about each media item, by media id.
+
+    Each entry is a dict with the item's filename, size, checksum and status
+    ('done', 'duplicate' or 'failed', with the number of failures in a row). Entries are appended to the file at path as lines of
+    JSON and flushed to disk one by one, so once ``record()`` returns the
+    entry survives a crash. A torn last line (from a crash while writing it)
+    is ignored. Later lines for an id replace earlier ones; ``compact()``
+    rewrites the file with just the latest entries.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._entries = {}
+        self._lines = 0
+        try:
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    self._entries[entry.pop('id')] = entry
+                    self._lines += 1
+        except FileNotFoundError:
+            pass
+        self._lock = threading.Lock()
+        self._file = open(path, 'a')
+        # Finish off a torn last line, so the next entry starts on a line of its own
+        if self._file.tell() > 0:
+            with open(path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    self._file.write('\n')
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, id):
+        """Return the entry for id, or None."""
+        return self._entries.get(id)
+
+    def done(self, id):
+        """Whether the item id has been synced (or skipped as a duplicate)."""
+        entry = self._entries.get(id)
+        return entry is not None and entry['status'] in ('done', 'duplicate')
+
+    def failures(self, id):
+        """How many times in a row the item id failed to sync."""
+        entry = self._entries.get(id)
+        return entry.get('failures', 1) if entry is not None and entry['status'] == 'failed' else 0
+
+    def record(self, id, **entry):
+        """Save the entry for id."""
+        line = json.dumps(dict(entry, id=id)) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._entries[id] = entry
+            self._lines += 1
+
+    def compact(self):
+        """Rewrite the file with one line per item, if that makes it noticeably shorter."""
+        with self._lock:
+            if self._lines < 2 * len(self._entries):
+                return
+            data = ''.join(json.dumps(dict(entry, id=id)) + '\n' for id, entry in self._entries.items())
+            self._file.close()
+            try:
+                atomic_write(self.path, data)
+                self._lines = len(self._entries)
+            finally:
+                # Keep appending, to the new file if it was written
+                self._file = open(self.path, 'a')
+
+    def close(self):
+        with self._lock:
+            self._file.close()
@@ -0,0 +1,98 @@
+"""
+Indexing the pictures directories: grouping pictures by day, and a persistent
+index so we can start without listing the directories.
+"""
+
+import heapq
+import json
+import os
+from collections import defaultdict
+
+from atomic import atomic_write
+
+INDEX_VERSION = 4
+
+def picday(filename, dates=None):
+    """The day of a picture, from the first 8 characters of its name (without its directories).
+
+    If given, dates maps the names of pictures not named by date to their day
+    (see exifdates.py).
+    """
+    if dates:
+        day = dates.get(filename)
+        if day is not None:
+            return day
+    return filename.rpartition(os.sep)[2][:8]
+
+def sort_key(filename):
+    """Sort pictures by name, whatever directory they are in, so they sort chronologically."""
+    return filename.rpartition(os.sep)[2], filename
+
+def group_by_day(data, dates=None):
+    """Group picture filenames like 20200528.jpg into days (see picday() for dates)."""
+    groups = defaultdict(list)
+    for name in data:
+        groups[picday(name, dates)].append(name)
+    return groups
+
+def read_index(path, directories):
+    """Return (state, weeks, files) from the index at path, or None if there is no usable index.
+
+    state is what the watcher of directories saved when the index was written
+    (see watcher.watch_library()), and weeks maps each day to its ISO week (or None).
+    files are all of the files in the directories, sorted by sort_key(), so we
+    can start without sorting them.
+    """
+    try:
+        with open(path, 'r') as f:
+            index = json.loads(f.read())
+        if index.get('version') != INDEX_VERSION or index.get('directories') != list(directories):
+            return None
+        state = {}
+        for directory in directories:
+            names = index['files'][directory]
+            if directory not in index['shards']:
+                state[directory] = names
+                continue
+            # Put the files back in their shards
+            shards = {shard: [mtime, [], subdirs] for shard, (mtime, subdirs) in index['shards'][directory].items()}
+            for name in names:
+                shard, _, name = name.rpartition(os.sep)
+                shards[shard][1].append(name)
+            state[directory] = shards
+    except (OSError, ValueError, KeyError):
+        return None
+    files = [index['files'][directory] for directory in directories]
+    if len(files) == 1:
+        return state, index['weeks'], files[0]
+    # A name in more than one directory is one file
+    merged = []
+    for name in heapq.merge(*files, key=sort_key):
+        if not merged or merged[-1] != name:
+            merged.append(name)
+    return state, index['weeks'], merged
+
+def write_index(path, directories, state, weeks):
+    """Write the index for directories, given the state of their watcher (see read_index()).
+
+    Each name is saved once, in the sorted files of its directory; the shards
+    of a sharded directory just keep their mtime and subdirectories.
+    """
+    files = {}
+    shards = {}
+    for directory in directories:
+        saved = state[directory]
+        if isinstance(saved, dict):
+            names = [os.path.join(shard, name) for shard, (_, shard_files, _) in saved.items() for name in shard_files]
+            shards[directory] = {shard: [mtime, subdirs] for shard, (mtime, _, subdirs) in saved.items()}
+        else:
+            names = saved
+        files[directory] = sorted(names, key=sort_key)
+    index = {
+        'version': INDEX_VERSION,
+        'directories': list(directories),
+        'weeks': weeks,
+        'shards': shards,
+        'files': files,
+    }
+    atomic_write(path, json.dumps(index, separators=(',', ':')))
@@ -0,0 +1,95 @@
+"""
+An append-only journal of program state that survives restarts.
+"""
+
+import os
+import queue
+import threading
+
+from atomic import atomic_write
+
+def read_journal(path):
+    """Return the list of (command, argument) records in the journal at path.
+
+    A partly written last record (e.g., from a power cut) is ignored.
+    """
+    try:
+        with open(path, 'r') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return []
+    lines = data.split('\n')
+    # Everything after the last newline is an incomplete record
+    records = []
+    for line in lines[:-1]:
+        command, _, argument = line.partition('\t')
+        records.append((command, argument))
+    return records
+
+def format_records(records):
+    return ''.join(f'{command}\t{argument}\n' for command, argument in records)
+
+class Journal:
+    """Append (command, argument) records to a file from a background thread.
+
+    ``append()`` and ``compact()`` only queue work, so they never wait for
+    the disk. ``compact()`` replaces the whole journal with the given records,
+    which should describe the current state. ``records`` counts the records
+    added since the journal was last compacted, starting from the given
+    number of records already in the file.
+    """
+
+    def __init__(self, path, records=0):
+        self.path = path
+        self.records = records
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._write, name='journal', daemon=True)
+        self._thread.start()
+
+    def append(self, command, argument=''):
+        self.records += 1
+        self._queue.put(('append', [(command, argument)]))
+
+    def compact(self, records):
+        self.records = 0
+        self._queue.put(('compact', list(records)))
+
+    def close(self):
+        """Write everything queued, then stop the writer thread."""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _write(self):
+        while True:
+            item = self._queue.get()
+            # Batch up everything that is waiting into one write
+            batch = [item]
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            appends = []
+            for item in batch:
+                if item is None:
+                    self._append(appends)
+                    return
+                action, records = item
+                if action == 'append':
+                    appends.extend(records)
+                else:
+                    # Anything appended before a compaction is already part of it
+                    appends = []
+                    self._rewrite(records)
+            self._append(appends)
+
+    def _append(self, records):
+        if not records:
+            return
+        with open(self.path, 'a') as f:
+            f.write(format_records(records))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _rewrite(self, records):
+        atomic_write(self.path, format_records(records))
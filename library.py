@@ -0,0 +1,432 @@
+"""
+The pictures we can show and how we pick them, independent of any display.
+"""
+
+import datetime
+import os
+import threading
+from bisect import bisect_left, bisect_right, insort
+from concurrent.futures import ThreadPoolExecutor
+from math import log
+from random import SystemRandom
+
+from deleted import DeletedPictures
+from duplicates import DuplicateIndex
+from exifdates import ExifDates
+from index import read_index, write_index, picday, group_by_day, sort_key
+from journal import Journal, read_journal
+from sampler import WeightedSampler
+from watcher import watch_library
+from weights import WeekWeights, picweek
+
+def is_picture(filename):
+    # Hidden files are pictures still being written (see experiment/download_photos.py), and
+    # hidden directories are things like the trash
+    return (not filename.endswith('.json') and not filename.startswith('.')
+            and os.sep + '.' not in filename)
+
+class PictureLibrary:
+    """The pictures in one or more directories, and which of them to show next.
+
+    Pictures are picked by day: days are weighted by how close their week is
+    to the current week and by the logarithm of how many pictures are left in
+    them (see the readme). ``pick()`` takes a picture out of the pictures left
+    to pick, and ``mark_seen()`` records that a picture was shown. Once hardly
+    any pictures are left (by weight), a new cycle starts with all pictures.
+
+    The seen pictures, the history of shown pictures and ``next`` (the random
+    picture picked to be shown next) are kept in journal_file across
+    restarts. Deleted pictures are kept in deleted_file. If index_file is
+    given, the list of files is saved there so that the directories do not
+    need to be listed (or sorted) before we can start.
+
+    directories is a directory or a list of them. They can be flat or
+    sharded into subdirectories (e.g., YYYY/MM/); pictures are named by their
+    path relative to their directory and sorted by their name, whatever
+    directory they are in. watcher is what keeps track of the files (see
+    watcher.py); by default we watch directories.
+
+    If duplicates_file is given, it is a duplicate index (see duplicates.py),
+    and only the original of each group of near-duplicates is up for picking.
+    The index is reloaded in the background whenever it is saved.
+
+    If exif_dates_file is given, the dates of pictures whose names don't
+    start with one are read from their EXIF data in the background, at most
+    exif_files_per_second a second, and kept there (see exifdates.py). A
+    picture moves to its day as soon as its date is read.
+    """
+
+    def __init__(self, directories, journal_file, deleted_file, index_file=None, kernel='normal',
+                 journal_compact_records=1000, watcher=None, random=None, duplicates_file=None,
+                 exif_dates_file=None, exif_files_per_second=10):
+        if isinstance(directories, str):
+            directories = [directories]
+        self.directories = list(directories)
+        self.index_file = index_file
+        self.journal_compact_records = journal_compact_records
+        self.random = random if random is not None else SystemRandom()
+        self.deleted = DeletedPictures(deleted_file)
+        self.duplicates = DuplicateIndex(duplicates_file) if duplicates_file else None
+        # A newer duplicate index, loaded in the background, for refresh() to switch to
+        self._new_duplicates = None
+        self.exif_dates = ExifDates(exif_dates_file, exif_files_per_second) if exif_dates_file else None
+        # The days of pictures not named by date, by name
+        self.dates = self.exif_dates.days if self.exif_dates is not None else {}
+
+        # The pictures left to pick, sorted (by sort_key), and grouped by day
+        self.files = []
+        self.groups = {}
+
+        # The ISO week of each day we have come across (None if the day is not a date),
+        # kept across rescans and saved in the index
+        self.weeks = {}
+
+        # The days with pictures left to pick, weighted for picking, and the
+        # week of the year the weights were calculated for
+        self.week_weights = WeekWeights(kernel)
+        self.sampler = WeightedSampler()
+        self.weights_week = None
+
+        # The pics we have already seen in the current cycle of pictures
+        self.seen = set()
+
+        # Total history of filenames that have been shown, even across `seen` resets
+        self.history = []
+
+        # The random picture picked to be shown next
+        self.next = None
+        # Whether next was removed and a new one should be picked
+        self._next_gone = False
+
+        # Keeps track of the files in the directories, so new and removed pictures are
+        # applied as they come instead of rescanning everything. If we have an index,
+        # we start from it and check it against the directories in the background.
+        index = read_index(index_file, self.directories) if index_file else None
+        if watcher is not None:
+            self.watcher = watcher
+        elif index is None:
+            self.watcher = watch_library(self.directories)
+        else:
+            self.watcher = watch_library(self.directories, index[0])
+            self.weeks.update(index[1])
+        # Whether the index on disk is out of date
+        self._index_dirty = index is None
+        # Saves the index in the background, one save at a time
+        self._index_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='index')
+
+        records = read_journal(journal_file)
+        self._replay(records)
+        self.journal = Journal(journal_file, len(records))
+
+        # Whether files and groups need to be rebuilt from scratch. If the index has them,
+        # we start from those instead, and apply the changes since it was saved.
+        self._rescan_needed = True
+        if index is not None and watcher is None:
+            self._restore(index[2])
+        self.refresh()
+
+        # The next random picture picked before a restart is not up for picking again. The
+        # index may be out of date until the directories are listed, so make sure it is still there.
+        if self.next in self.groups.get(self.day(self.next or ''), ()) and os.path.exists(self.path(self.next)):
+            self._remove(self.next)
+        else:
+            self.next = None
+        self._next_gone = False
+
+    def _replay(self, records):
+        """Restore the pictures seen, the history and the next random picture from journal records."""
+        for command, filename in records:
+            if command == 'seen':
+                self.seen.add(filename)
+            elif command == 'history':
+                self.history.append(filename)
+            elif command == 'next':
+                self.next = filename or None
+            elif command == 'reset':
+                self.seen.clear()
+
+    def _journal_state(self):
+        """Return the journal records that describe the current state."""
+        return ([('history', filename) for filename in self.history]
+                + [('seen', filename) for filename in self.seen]
+                + [('next', self.next or '')])
+
+    def day(self, filename):
+        """The day of a picture, from its name or else from its EXIF date (once we have read it)."""
+        return picday(filename, self.dates)
+
+    def day_week(self, day):
+        """The ISO week of a day, remembering it in weeks."""
+        if day not in self.weeks:
+            self.weeks[day] = picweek(day)
+        return self.weeks[day]
+
+    # weight the days logarithmically
+    # See https://docs.python.org/3.5/library/random.html#examples-and-recipes
+    def day_weight(self, day):
+        """The weight of a day, from its week and the number of pics left in it."""
+        # use log base N for weights, so one picture weights the day at 1.0,
+        # N pictures makes a weight of 2, N^2 pictures makes a weight of 3,
+        # N^3 pictures makes a weight of 4, and so on
+        return (log(len(self.groups[day]), 2)+1)*self.week_weights[self.weights_week][self.weeks[day]]
+
+    def rescan(self):
+        """Rebuild the pictures left to pick from all of the files in the directories."""
+        self.files = sorted((x for x in self.watcher.files if self._pickable(x)), key=sort_key)
+        self.groups = group_by_day(self.files, self.dates)
+        self._request_dates(self.groups)
+        for day in self.groups:
+            self.day_week(day)
+        self._rescan_needed = False
+        self.reweight()
+
+    def _pickable(self, filename):
+        """Whether filename can be picked in this cycle (ignoring whether it was already picked)."""
+        return (is_picture(filename) and filename not in self.seen and filename not in self.deleted
+                and not (self.duplicates is not None and filename in self.duplicates.duplicate_of))
+
+    def _restore(self, files):
+        """Set the pictures left to pick from the sorted files saved in the index."""
+        pictures = [x for x in files if is_picture(x)]
+        groups = group_by_day(pictures, self.dates)
+        excluded = self.seen | set(self.deleted)
+        if self.duplicates is not None:
+            excluded |= self.duplicates.duplicate_of.keys()
+        self.files = [x for x in pictures if x not in excluded]
+        self.groups = {}
+        for day, names in groups.items():
+            names = [x for x in names if x not in excluded]
+            if names:
+                self.groups[day] = names
+        for day in self.groups:
+            self.day_week(day)
+        self._request_dates(groups)
+        self._rescan_needed = False
+        self.reweight()
+
+    def reweight(self):
+        """Recalculate the weight of every day for the current week."""
+        self.weights_week = datetime.datetime.now().isocalendar()[1]
+        self.sampler = WeightedSampler(self.groups.keys(), map(self.day_weight, self.groups))
+
+    def refresh(self):
+        """Bring the pictures and weights up to date
+
+        The day weights are only recalculated from scratch when the pictures are
+        rescanned or the week changes. Picking a picture updates its day in place,
+        and pictures added to or removed from the directory are applied one by one.
+        """
+        added, removed = self.watcher.changes()
+        if added or removed:
+            self._index_dirty = True
+
+        if self._rescan_needed:
+            self.rescan()
+        else:
+            if datetime.datetime.now().isocalendar()[1] != self.weights_week:
+                self.reweight()
+            # Apply the changes in the directory since we last looked
+            for filename in removed:
+                self._discard(filename)
+            for filename in sorted(added):
+                self._add(filename)
+            self._refresh_duplicates()
+            self._refresh_dates()
+            self._replace_next()
+
+        # If we have hardly any pics left (by weight), reset everything so the scan picks up everything
+        # The threshold value relies on the log weighting scale and the kernel being normalized
+        if self.sampler.max()<=1e-5:
+            if self.seen:
+                self.seen = set()
+                self.journal.append('reset')
+            self.rescan()
+
+    def _refresh_duplicates(self):
+        """Switch to the duplicate index loaded in the background, and start loading it if it was saved."""
+        if self.duplicates is None:
+            return
+        if self._new_duplicates is not None:
+            old, self.duplicates = self.duplicates.duplicate_of, self._new_duplicates
+            self._new_duplicates = None
+            new = self.duplicates.duplicate_of
+            for filename in new.keys() - old.keys():
+                self._discard(filename)
+            for filename in old.keys() - new.keys():
+                if filename in self.watcher.files:
+                    self._add(filename)
+        elif self.duplicates.changed():
+            threading.Thread(target=self._load_duplicates, daemon=True).start()
+
+    def _load_duplicates(self):
+        self._new_duplicates = DuplicateIndex(self.duplicates.path, self.duplicates.radius)
+
+    def _request_dates(self, groups):
+        """Have the EXIF dates of the pictures in the undated days of groups read."""
+        if self.exif_dates is not None:
+            self.exif_dates.request((filename, self.path(filename)) for day, filenames in groups.items()
+                                    if self.day_week(day) is None for filename in filenames)
+
+    def _refresh_dates(self):
+        """Move the pictures whose EXIF dates were read since we last looked to their day."""
+        if self.exif_dates is None:
+            return
+        for filename, day in self.exif_dates.found():
+            left = filename in self.groups.get(self.day(filename), ())
+            if left:
+                self._remove(filename)
+            if day is None:
+                self.dates.pop(filename, None)
+            else:
+                self.dates[filename] = day
+            if left:
+                self._group(filename)
+
+    def _add(self, filename):
+        """Add a picture that just appeared in the directory to the pictures left to pick."""
+        if not self._pickable(filename):
+            return
+        index = bisect_left(self.files, sort_key(filename), key=sort_key)
+        if index < len(self.files) and self.files[index] == filename:
+            return
+        self.files.insert(index, filename)
+        self._group(filename)
+        self._request_dates({self.day(filename): [filename]})
+
+    def _group(self, filename):
+        """Add a picture to its day, updating the day's weight."""
+        day = self.day(filename)
+        if day in self.groups:
+            insort(self.groups[day], filename, key=sort_key)
+            self.sampler.update(day, self.day_weight(day))
+        else:
+            self.groups[day] = [filename]
+            self.day_week(day)
+            self.sampler.add(day, self.day_weight(day))
+
+    def _discard(self, filename):
+        """Forget a picture that was removed from the directory."""
+        index = bisect_left(self.files, sort_key(filename), key=sort_key)
+        if index < len(self.files) and self.files[index] == filename:
+            del self.files[index]
+        if filename in self.groups.get(self.day(filename), ()):
+            self._remove(filename)
+        if filename == self.next:
+            self.next = None
+            self._next_gone = True
+
+    def _replace_next(self):
+        """Pick a new next random picture if the one we had was removed."""
+        if not self._next_gone:
+            return
+        self._next_gone = False
+        self.pick_next()
+
+    def discard(self, filename):
+        """Forget a picture that can't be shown (e.g., it is gone or broken), picking a new next one if need be.
+
+        It comes back if it is added to the directory again, or in the next cycle.
+        """
+        self._discard(filename)
+        self._replace_next()
+
+    def _remove(self, filename):
+        """Remove a picture from the pictures left to pick, updating its day's weight."""
+        day = self.day(filename)
+        self.groups[day].remove(filename)
+        if len(self.groups[day])==0:
+            self.sampler.remove(day)
+            del self.groups[day]
+        else:
+            self.sampler.update(day, self.day_weight(day))
+
+    def pick(self):
+        """Return a random pic according to the distribution, taking it out of the pictures left to pick.
+
+        Return None if there are no pictures.
+        """
+        if not self.groups:
+            return None
+        if self.random.random() < 0.1:
+            # Every tenth time or so, pick a picture from a random day, just to
+            # change things up a bit
+            day = self.sampler.choice(self.random)
+        else:
+            # pick a day, weighted according to the day weights, then pick a random pic from that day
+            day = self.sampler.sample(self.random)
+
+        filename = self.random.choice(self.groups[day])
+
+        # Remove the one we just picked so we don't pick it again
+        self._remove(filename)
+        self.refresh()
+        return filename
+
+    def pick_next(self):
+        """Pick the random picture to show next (so it can be loaded ahead of time), and return it (or None)."""
+        self.next = self.pick()
+        self.journal.append('next', self.next or '')
+        if self.journal.records > self.journal_compact_records:
+            self.journal.compact(self._journal_state())
+        return self.next
+
+    def mark_seen(self, filename):
+        """Record that filename was shown, adding it to the history."""
+        self.history.append(filename)
+        self.seen.add(filename)
+        self.journal.append('history', filename)
+        self.journal.append('seen', filename)
+
+    def delete(self, filename):
+        """Never show filename again, not even by navigating to it."""
+        self.deleted.add(filename)
+        self.discard(filename)
+
+    def undo_delete(self):
+        """Restore the most recently deleted picture, returning it if it is still in the directory."""
+        filename = self.deleted.undo()
+        if filename is None:
+            return None
+        # Put it back as if it just appeared in the directory
+        self._discard(filename)
+        if filename not in self.watcher.files:
+            return None
+        self._add(filename)
+        return filename
+
+    def neighbors(self, filename):
+        """Return the pictures just before and just after filename in sorted (chronological) order.
+
+        Either is None if there is no such picture.
+        """
+        # The picture we want is just before where filename would be inserted
+        index = bisect_left(self.files, sort_key(filename), key=sort_key) - 1
+        before = self.files[index] if index > 0 else None
+        # and just after where it would have been
+        index = bisect_right(self.files, sort_key(filename), key=sort_key)
+        after = self.files[index] if index < len(self.files) else None
+        return before, after
+
+    def path(self, filename):
+        """Return the full path of a picture."""
+        return self.watcher.path(filename)
+
+    def save_index(self, background=True):
+        """Save the files in the directories to the index if they changed, by default in a background thread."""
+        if not self.index_file or not self._index_dirty:
+            return
+        self._index_dirty = False
+        saved = self._index_writer.submit(write_index, self.index_file, self.directories,
+                                          self.watcher.state(), dict(self.weeks))
+        if not background:
+            saved.result()
+
+    def close(self):
+        """Save the index and write out the journal."""
+        self.save_index(background=False)
+        self._index_writer.shutdown(wait=True)
+        self.journal.close()
+        self.deleted.close()
+        if self.exif_dates is not None:
+            self.exif_dates.close()
+        self.watcher.close()
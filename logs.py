@@ -0,0 +1,102 @@
+"""
+Logging that never makes the event loop wait on the disk.
+"""
+
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+
+class BufferedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """A log file that is flushed in batches and rotated by size or age.
+
+    Records are written to the file's buffer and only flushed to disk once
+    flush_seconds have passed since the last flush, or right away for
+    warnings and errors. If no more records come, LogListener flushes what is
+    buffered once it has waited flush_seconds. The file is rotated when it would grow over max_bytes
+    or has been in use for rotate_seconds (0 turns either check off).
+    """
+
+    def __init__(self, filename, max_bytes=0, backup_count=0, rotate_seconds=0, flush_seconds=60):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, delay=True)
+        self.rotate_seconds = rotate_seconds
+        self.flush_seconds = flush_seconds
+        self._opened = time.monotonic()
+        self._flushed = time.monotonic()
+        self._force_flush = False
+
+    def shouldRollover(self, record):
+        if self.rotate_seconds and time.monotonic() - self._opened >= self.rotate_seconds:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        self._opened = time.monotonic()
+
+    def emit(self, record):
+        self._force_flush = record.levelno >= logging.WARNING
+        super().emit(record)
+
+    def flush(self):
+        # StreamHandler.emit() flushes after every record; only do it every so often
+        if self._force_flush or time.monotonic() - self._flushed >= self.flush_seconds:
+            super().flush()
+            self._flushed = time.monotonic()
+
+    def close(self):
+        self._force_flush = True
+        super().close()
+
+
+class LogListener(logging.handlers.QueueListener):
+    """A QueueListener that also flushes its handlers when no record has come for flush_seconds.
+
+    ``stop()`` writes out everything still buffered and closes the handlers.
+    """
+
+    def __init__(self, queue, *handlers, flush_seconds=60):
+        super().__init__(queue, *handlers)
+        self.flush_seconds = flush_seconds
+
+    def dequeue(self, block):
+        while True:
+            try:
+                return self.queue.get(block, timeout=self.flush_seconds)
+            except queue.Empty:
+                for handler in self.handlers:
+                    handler.flush()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        super().stop()
+        for handler in self.handlers:
+            handler.close()
+
+
+def setup_logging(name, filename, level=logging.INFO, max_bytes=1024*1024, backup_count=3,
+                  rotate_seconds=0, flush_seconds=60):
+    """Set up the logger name to write to the console and filename from a background thread.
+
+    Return the LogListener doing the writing. Call its ``stop()`` before
+    exiting to write out everything still buffered.
+    """
+    formatter = logging.Formatter('%(asctime)s %(message)s')
+    formatter.default_msec_format = '%s.%03d'
+    file_handler = BufferedRotatingFileHandler(filename, max_bytes=max_bytes, backup_count=backup_count,
+                                               rotate_seconds=rotate_seconds, flush_seconds=flush_seconds)
+    console_handler = logging.StreamHandler(sys.stdout)
+    for handler in (file_handler, console_handler):
+        handler.setFormatter(formatter)
+
+    records = queue.SimpleQueue()
+    logger = logging.getLogger(name)
+    logger.setLevel(level)
+    logger.addHandler(logging.handlers.QueueHandler(records))
+    logger.propagate = False
+
+    listener = LogListener(records, file_handler, console_handler, flush_seconds=flush_seconds)
+    listener.start()
+    return listener
@@ -10,19 +10,51 @@ import pygame
 import os
 import pygame.freetype
 import datetime
-from bisect import bisect, bisect_left, bisect_right
-from collections import defaultdict
-from math import log
-import itertools
-from normdist import NormalDist
+import logging
+import atexit
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from control import ControlServer
+from duplicates import duplicates_file
+from library import PictureLibrary
+from weights import picweek
+from prefetch import Prefetcher
+from cache import SurfaceCache
+from pixelcache import PixelCache, pixel_format
+from logs import setup_logging
+from stats import Stats
+from render import Renderer, fit
 from blanking_console import Console
 from blanking_wayland import Wayland
 
-def logmsg(msg):
-    timemsg =f"{datetime.datetime.now()} {msg}" 
-    print(timemsg)
-    with open('pictures.log', 'a') as f:
-        f.write(timemsg+'\n')
+# Messages below LOG_LEVEL are dropped (the minute-by-minute messages are DEBUG).
+# The log is written from a background thread, flushed to disk within about
+# LOG_FLUSH_SECONDS (warnings and errors right away), and rotated once it gets
+# to LOG_MAX_BYTES or is LOG_ROTATE_SECONDS old (0 to only rotate by size).
+LOG_FILE = 'pictures.log'
+LOG_LEVEL = logging.INFO
+LOG_MAX_BYTES = 1024 * 1024
+LOG_BACKUPS = 3
+LOG_ROTATE_SECONDS = 0
+LOG_FLUSH_SECONDS = 60
+
+LOG_LISTENER = setup_logging('pictures', LOG_FILE, level=LOG_LEVEL, max_bytes=LOG_MAX_BYTES,
+                             backup_count=LOG_BACKUPS, rotate_seconds=LOG_ROTATE_SECONDS,
+                             flush_seconds=LOG_FLUSH_SECONDS)
+# Write out what is buffered however we exit (it is also stopped at the end of the main loop)
+atexit.register(LOG_LISTENER.stop)
+logger = logging.getLogger('pictures')
+
+def logmsg(msg, level=logging.INFO):
+    logger.log(level, msg)
+
+# Time the event handlers, picture decoding and display commands, and how long
+# events wait in the queue. When STATS_ENABLED, a summary is logged every
+# STATS_LOG_MINUTES and the latest numbers are saved in STATS_FILE every minute.
+STATS_ENABLED = False
+STATS_LOG_MINUTES = 60
+STATS_FILE = 'pictures_stats.json'
+STATS = Stats(enabled=STATS_ENABLED)
 
 
 # Create the right display object
@@ -30,7 +62,6 @@ for c in (Wayland, Console):
     if c.active():
         logmsg(f"display {c}")
         DISPLAY = c()
-        logmsg(f"display on: {DISPLAY.on(check=True)}")
         break
 
 # Set the variables so we can easily change the program
@@ -39,14 +70,60 @@ SMALL_SCREEN_SIZE=(600,400)
 DISPLAY_TIME_MS = 40 * 60 * 1000 # milliseconds a picture is displayed by default
 FONTSIZE = 120
 
+# Milliseconds to crossfade from one picture to the next (0 to just switch), and the
+# frame rate to aim for while fading (fewer frames are drawn if the Pi can't keep up)
+TRANSITION_MS = 0
+TRANSITION_FPS = 30
+
 # The default text format:
 # - 0: no text
 # - 1: date
 # - 2: filename
 FORMAT = 1
 
-# The directory of pictures
-PIC_DIRECTORY = '/home/pi/Export1080p/'
+# The kernel used to weight days by their distance from the current week: 'normal', 'power' or 'linear'
+KERNEL = 'normal'
+
+# Number of threads decoding pictures ahead of time
+PREFETCH_WORKERS = 2
+
+# Memory budget for decoded pictures (a 1080p picture takes about 8 MB)
+CACHE_BYTES = 64 * 1024 * 1024
+
+# A directory to keep decoded pictures in as raw pixels (see pixelcache.py), so pictures
+# shown recently or prefetched before are memory-mapped instead of decoded again, and
+# the most disk space it can take. Each picture takes about 8 MB, so this writes a lot
+# to an SD card; set to None to decode every time.
+PIXEL_CACHE_DIR = None
+PIXEL_CACHE_BYTES = 2 * 1024 * 1024 * 1024
+
+# The directories of pictures. Each can be flat or sharded into subdirectories
+# (e.g., YYYY/MM/); they are all shown as one library.
+PIC_DIRECTORIES = ['/home/pi/Export1080p/']
+
+# Where we save the list of pictures so we can start without listing PIC_DIRECTORIES
+INDEX_FILE = 'picture_index.json'
+
+# The perceptual hashes of the pictures (see duplicates.py), so near-duplicates are
+# only shown once. Set to None to show every picture.
+DUPLICATES_FILE = duplicates_file(PIC_DIRECTORIES[0])
+
+# Where we keep the dates read from the EXIF data of pictures whose names don't start
+# with one, and how many pictures a second to read them from in the background.
+# Set to None to treat those pictures as undated.
+EXIF_DATES_FILE = 'picture_dates.json'
+EXIF_FILES_PER_SECOND = 10
+
+# Where we keep the pictures seen, the history and the next random picture across restarts
+JOURNAL_FILE = 'pictures_journal.txt'
+# Rewrite the journal with just the current state after this many records
+JOURNAL_COMPACT_RECORDS = 1000
+
+# Seconds we trust the cached display on/off state before checking it again in the background
+DISPLAY_STATE_MAX_AGE = 60
+
+# The Unix socket scripts can send commands to (see the readme), or None for no socket
+CONTROL_SOCKET = 'pictures.sock'
 
 # Time (hour, minute) of sleep and wake each day
 WAKE = (6, 30)
@@ -58,51 +135,65 @@ def format_filename(filename):
     if FORMAT == 0:
         return ''
     elif FORMAT == 1:
-        if filename[0] == '2':
-            return datetime.datetime.strptime(filename[:8], "%Y%m%d").strftime("%d %b %Y")
+        # The date from the name, or from the EXIF data once it has been read
+        day = LIBRARY.day(filename)
+        if picweek(day) is not None:
+            return datetime.datetime.strptime(day, "%Y%m%d").strftime("%d %b %Y")
         else:
             return ''
     elif FORMAT == 2:
-        return os.path.splitext(filename)[0]
+        return os.path.splitext(os.path.basename(filename))[0]
     
-def picday(filename):
-    return filename[:8]
-
-def group_by_day(data):
-    """Group picture filenames like 20200528.jpg into days."""
-    groups = defaultdict(list)
-    for name in data:
-        groups[picday(name)].append(name)
-    return groups
-
 # Define custom pygame events we will use.
 PICTURE_CHANGE = pygame.USEREVENT
 SCREEN_SLEEP = pygame.USEREVENT + 1
 SCREEN_WAKE = pygame.USEREVENT + 2
 UPDATE_TIME = pygame.USEREVENT + 3
+DISPLAY_WOKE = pygame.USEREVENT + 4
+TRANSITION_FRAME = pygame.USEREVENT + 5
+CONTROL = pygame.USEREVENT + 6
+
+# Names for the event handler timings
+EVENT_NAMES = {PICTURE_CHANGE: 'PictureChange', SCREEN_SLEEP: 'ScreenSleep', SCREEN_WAKE: 'ScreenWake',
+               UPDATE_TIME: 'UpdateTime', DISPLAY_WOKE: 'DisplayWoke', TRANSITION_FRAME: 'TransitionFrame',
+               CONTROL: 'Control'}
+
+# Display commands run in the background; tell the event loop when a wake is done
+logmsg(f"display on: {DISPLAY.start(max_age=DISPLAY_STATE_MAX_AGE, stats=STATS)}")
+
+def post(event_type, **attributes):
+    """Post an event from any thread, noting when it was posted so we can time how long it waits."""
+    pygame.event.post(pygame.event.Event(event_type, posted=time.monotonic(), **attributes))
+
+def post_woke(on):
+    post(DISPLAY_WOKE, on=on)
 
 random = SystemRandom()
 
 CURRENT_FILENAME = None
 CURRENT_IMAGE = None
 
-DELETED_PICS_FILE = 'deleted_pics.txt'
-
-if os.path.exists(DELETED_PICS_FILE):
-    with open(DELETED_PICS_FILE, 'r') as f:
-        DELETED_PICS = set(f.read().splitlines())
-else:
-    DELETED_PICS = set()
+# While running a batch of control commands, pictures are only shown once at the end
+DEFER_SHOW = False
+SHOW_PENDING = False
+# The random picture picked in the batch, to record once it has been shown
+PENDING_RANDOM = None
 
-NEXT_RANDOM_FILENAME = None
-NEXT_RANDOM_IMAGE = None
-
-NEXT_FILENAME = None
-NEXT_IMAGE = None
+DELETED_PICS_FILE = 'deleted_pics.txt'
 
+@STATS.timed('decode')
 def load(filename):
+    """Decode a picture and scale it to fit the screen (this runs on the prefetch threads).
+
+    Pictures in the pixel cache are memory-mapped from there instead, and
+    pictures we decode are saved in it.
+    """
+    path = LIBRARY.path(filename)
+    if PIXEL_CACHE is not None:
+        image = PIXEL_CACHE.get(filename, path)
+        if image is not None:
+            return image
     try:
-        path = os.path.join(PIC_DIRECTORY, filename)
         image = pygame.image.load(path).convert()
     except:
         print(f"Error loading file ${path}")
@@ -111,137 +202,57 @@ def load(filename):
     # to trap that error early.
     if image is None:
         raise ValueError(f"Could not load image ${filename}")
+    image = fit(image, screen.get_size())
+    if PIXEL_CACHE is not None:
+        PIXEL_CACHE.put(filename, path, image)
     return image
 
-def show(file = None):
-    """Show a picture. file is a (filename, pygame image) pair. If file not specified, refresh the current picture."""
+@STATS.timed('show')
+def show(filename = None):
+    """Show a picture, taking its image from the picture cache. If filename not specified, refresh the current picture.
+
+    Return False if the picture could not be loaded; it is forgotten by the library, and
+    the picture on the screen stays as it was.
+    """
     global CURRENT_FILENAME
     global CURRENT_IMAGE
+    global SHOW_PENDING
 
-    if file is not None:
-        CURRENT_FILENAME, CURRENT_IMAGE = file
-
-    screen_width = screen.get_width()
-    screen_height = screen.get_height()
-
-    # blank the screen
-    screen.fill([0,0,0])
-
-    # Show the image
-    if FULLSCREEN:
-        offset = round((screen_width - CURRENT_IMAGE.get_width()) / 2)
-        screen.blit(CURRENT_IMAGE, (offset, 0))
-    else:
-        pygame.transform.smoothscale(CURRENT_IMAGE, SMALL_SCREEN_SIZE, screen) # development
-
-    # Put the filename 5 pixels from the bottom of the screen, 10 pixels from left edge
-    words = font.render( format_filename(CURRENT_FILENAME),  fgcolor=(255,255,255), bgcolor=(0,0,0,100))
-    screen.blit(words[0], (10, screen_height - words[0].get_height() - 5))
-
-    # Time is 5 pixels from bottom, 10 pixels from right edge
-    datetext = font.render( datetime.datetime.now().strftime("%H:%M"), fgcolor=(255,255,255), bgcolor=(0,0,0,100))
-    screen.blit(datetext[0], (screen_width - datetext[0].get_width() - 10, screen_height - datetext[0].get_height() - 5))
-
-    pygame.display.flip()
-
-# Total history of filenames that have been viewed since the program start, even across `seen` resets
-PIC_HISTORY = []
-
-# The position of the current picture in the history array
-PIC_HISTORY_INDEX = len(PIC_HISTORY) - 1
-
-# Tracking data for the list of possible pictures, weights, etc.
-PIC_FILES = []
-PIC_DIRECTORY_MTIME = None
-PIC_GROUPS = []
-PIC_DAYS = []
-DAY_WEIGHTS = []
-CUM_DAY_WEIGHTS = []
-
-# The pics we have already seen in the current cycle of pictures. This can be reset
-# if we don't have many pictures left to show.
-PICS_SEEN = set()
-
-# weight the days logarithmically
-# See https://docs.python.org/3.5/library/random.html#examples-and-recipes
-
-def reset_weights():
-    """Reset the weights on the remaining pics in groups and days"""
-    global PIC_DIRECTORY_MTIME, PIC_FILES, PICS_SEEN, DAY_WEIGHTS, CUM_DAY_WEIGHTS, PIC_GROUPS, PIC_DAYS
-
-    # If we have hardly any pics left (by weight), reset everything so the scan picks up everything
-    # The threshold value relies on the log weighting scale and the kernel being normalized
-    if max(DAY_WEIGHTS or [0])<=1e-5:
-        PICS_SEEN = set()
-        PIC_DIRECTORY_MTIME = None
-
-    # If the pic directory has changed (or mtime been reset), rescan all the files
-    if  PIC_DIRECTORY_MTIME != os.path.getmtime(PIC_DIRECTORY):
-        PIC_FILES = sorted(set(x for x in os.listdir(PIC_DIRECTORY) if not x.endswith('.json')) - PICS_SEEN - DELETED_PICS)
-        PIC_DIRECTORY_MTIME = os.path.getmtime(PIC_DIRECTORY)
-        PIC_GROUPS = group_by_day(PIC_FILES)
-        PIC_DAYS = list(PIC_GROUPS.keys())
-
-    # Calculate the weights applied to each day based on how far their week
-    # is from the current week
-    current_week = datetime.datetime.now().isocalendar()[1]
-
-    kernel = NormalDist(0, 1.5).pdf
+    if DEFER_SHOW:
+        if filename is not None:
+            CURRENT_FILENAME, CURRENT_IMAGE = filename, None
+        SHOW_PENDING = True
+        return True
 
-    # Power law fall-off
-    # kernel = lambda x: (x+1)**-1.5
-
-    # Linear fall-off
-    # kernel = lambda x: max(1-.2*x, 0)
-
-    normalization = kernel(0)
-    def day_weight(day):
+    transition_ms = 0
+    if filename is not None:
         try:
-            d = datetime.datetime(int(day[:4]), int(day[4:6]), int(day[6:8]))
-        except:
-            # pictures without a date are automatically preferred as if they were 4 weeks away
-            return kernel(3)/normalization
-        week = d.isocalendar()[1]
-        tmp = abs(current_week - week)
-        # Absolute distance of the day's week from the current week
-        distance = min(tmp, 53-tmp)
-        # Weight the day by kernel
-        return kernel(distance)/normalization
-
-    # use log base N for weights, so one picture weights the day at 1.0,
-    # N pictures makes a weight of 2, N^2 pictures makes a weight of 3,
-    # N^3 pictures makes a weight of 4, and so on
-    DAY_WEIGHTS = [(log(len(PIC_GROUPS[day]), 2)+1)*day_weight(day) for day in PIC_DAYS]
-    CUM_DAY_WEIGHTS = list(itertools.accumulate(DAY_WEIGHTS))
-
-    #for (d,w) in sorted(zip(days, weights), key=lambda x: x[1]):
-    #    print(d,"%f"%day_weight(d), "%f"%w)
-
+            image = PREFETCHER.get(filename)
+        except (OSError, pygame.error, ValueError) as e:
+            logmsg(f"Could not load {filename}: {e!r}", logging.WARNING)
+            LIBRARY.discard(filename)
+            if filename == CURRENT_FILENAME:
+                # A deferred show, so there is nothing on the screen to refresh
+                CURRENT_FILENAME = None
+            return False
+        CURRENT_FILENAME, CURRENT_IMAGE = filename, image
+        transition_ms = TRANSITION_MS
+    elif CURRENT_FILENAME is None:
+        return True
+
+    # The rest of a crossfade is drawn on TRANSITION_FRAME events, so keys are handled in between
+    pygame.time.set_timer(TRANSITION_FRAME, RENDERER.show(CURRENT_IMAGE, format_filename(CURRENT_FILENAME), transition_ms))
+    return True
+
+# Load the pictures (reading the index and journal, and listing the directory if
+# there is no index) in the background while pygame and the display start up
 logmsg("Loading pictures...")
-reset_weights()
-logmsg("Loaded!")
-
-def choose_random_pic():
-    """Return a random pic according to the distribution"""
-    if random.random() < 0.1:
-        # Every tenth time or so, pick a picture from a random day, just to
-        # change things up a bit
-        day = random.choice(PIC_DAYS)
-    else:
-        # pick a day, weighted according to cumdist, then pick a random pic from that day
-        # See https://docs.python.org/3.5/library/random.html#examples-and-recipes
-        day = PIC_DAYS[bisect(CUM_DAY_WEIGHTS, random.random() * CUM_DAY_WEIGHTS[-1])]
-    
-    filename = random.choice(PIC_GROUPS[day])
-
-    # Update the global pic data to remove the one we just showed picked so we
-    # don't pick it again
-    PIC_GROUPS[day].remove(filename)
-    if len(PIC_GROUPS[day])==0:
-        PIC_DAYS.remove(day)
-        del PIC_GROUPS[day]
-    reset_weights()
-    return filename
+LOADER = ThreadPoolExecutor(max_workers=1)
+LIBRARY_LOADING = LOADER.submit(PictureLibrary, PIC_DIRECTORIES, JOURNAL_FILE, DELETED_PICS_FILE,
+                                index_file=INDEX_FILE, kernel=KERNEL, duplicates_file=DUPLICATES_FILE,
+                                exif_dates_file=EXIF_DATES_FILE, exif_files_per_second=EXIF_FILES_PER_SECOND,
+                                journal_compact_records=JOURNAL_COMPACT_RECORDS, random=random)
+LOADER.shutdown(wait=False)
 
 # Start pygame up, setting allowed events
 pygame.freetype.init()
@@ -254,6 +265,185 @@ if FULLSCREEN:
 else:
     screen = pygame.display.set_mode(SMALL_SCREEN_SIZE) # development
 font = pygame.freetype.SysFont('freesans', FONTSIZE)
+RENDERER = Renderer(screen, font, fps=TRANSITION_FPS)
+
+LIBRARY = LIBRARY_LOADING.result()
+del LIBRARY_LOADING
+logmsg("Loaded!")
+
+# The position of the current picture in the history of pictures shown
+PIC_HISTORY_INDEX = len(LIBRARY.history) - 1
+
+# Decode pictures in the background (after set_mode, since load() converts to the screen format)
+# into a cache shared by all the navigation keys
+PICTURE_CACHE = SurfaceCache(CACHE_BYTES)
+PIXEL_CACHE = (PixelCache(PIXEL_CACHE_DIR, PIXEL_CACHE_BYTES, screen.get_size(), pixel_format(screen))
+               if PIXEL_CACHE_DIR else None)
+PREFETCHER = Prefetcher(load, PICTURE_CACHE, workers=PREFETCH_WORKERS)
+
+def prefetch_neighbors():
+    """Start decoding the pictures any navigation key could show next."""
+    candidates = [LIBRARY.next]
+    if PIC_HISTORY_INDEX > 0:
+        candidates.append(LIBRARY.history[PIC_HISTORY_INDEX - 1])
+    if PIC_HISTORY_INDEX < len(LIBRARY.history) - 1:
+        candidates.append(LIBRARY.history[PIC_HISTORY_INDEX + 1])
+    if CURRENT_FILENAME is not None:
+        # The same pictures the up/down keys would pick
+        candidates.extend(LIBRARY.neighbors(CURRENT_FILENAME))
+    PREFETCHER.prefetch(c for c in candidates if c is not None)
+
+def mark_seen(filename):
+    """Record that the random picture filename was shown, moving to the end of the history."""
+    global PIC_HISTORY_INDEX
+    LIBRARY.mark_seen(filename)
+    PIC_HISTORY_INDEX = len(LIBRARY.history) - 1
+
+def show_random():
+    """Show the next random picture (if the display is on), adding it to the history."""
+    global PENDING_RANDOM
+    if DISPLAY.is_on():
+        filename = LIBRARY.next if LIBRARY.next is not None else LIBRARY.pick()
+        if filename is None:
+            # No pictures (yet), so try again later
+            pygame.time.set_timer(PICTURE_CHANGE,DISPLAY_TIME_MS)
+            return
+        if not show(filename):
+            # Try another picture right away
+            post(PICTURE_CHANGE)
+            return
+        if DEFER_SHOW:
+            # Not loaded yet: run_commands() records it once it is shown
+            PENDING_RANDOM = filename
+        else:
+            mark_seen(filename)
+
+        # Pick the next random picture now so it can be decoded before we need it
+        LIBRARY.pick_next()
+        prefetch_neighbors()
+
+    pygame.time.set_timer(PICTURE_CHANGE,DISPLAY_TIME_MS)
+
+def show_other(filename):
+    """Show a picture the user navigated to, restarting the picture timer."""
+    if show(filename):
+        prefetch_neighbors()
+        pygame.time.set_timer(PICTURE_CHANGE,DISPLAY_TIME_MS)
+
+def show_history(step):
+    """Show the picture step pictures later (or earlier, if negative) in the history."""
+    global PIC_HISTORY_INDEX
+    if 0 <= PIC_HISTORY_INDEX + step < len(LIBRARY.history):
+        PIC_HISTORY_INDEX += step
+        show_other(LIBRARY.history[PIC_HISTORY_INDEX])
+
+def show_neighbor(later):
+    """Show the next (or previous) picture in sorted order that we haven't seen yet (i.e., chronologically).
+
+    Do not put this pic in our history.
+    """
+    if CURRENT_FILENAME is None:
+        return
+    filename = LIBRARY.neighbors(CURRENT_FILENAME)[1 if later else 0]
+    if filename is not None:
+        show_other(filename)
+
+def change_format(format=None):
+    """Change the date format to format, or to the next one."""
+    global FORMAT
+    FORMAT = (FORMAT+1) % 3 if format is None else format
+    show()
+
+def delete_current():
+    """Mark the current picture to not be shown again."""
+    if CURRENT_FILENAME:
+        LIBRARY.delete(CURRENT_FILENAME)
+
+def undo_delete():
+    """Undo the last deletion, showing the picture again."""
+    filename = LIBRARY.undo_delete()
+    if filename is not None:
+        logmsg(f"Restored deleted picture {filename}")
+        show_other(filename)
+
+def status():
+    """Return the state of the frame for the control socket."""
+    return {
+        'filename': CURRENT_FILENAME,
+        'format': FORMAT,
+        'display_on': DISPLAY.is_on(),
+        'history': len(LIBRARY.history),
+        'history_index': PIC_HISTORY_INDEX,
+        'next': LIBRARY.next,
+        'pictures_left': len(LIBRARY.files),
+        'seen': len(LIBRARY.seen),
+        'deleted': len(LIBRARY.deleted),
+        'cache': repr(PICTURE_CACHE),
+    }
+
+# The control socket commands, taking the command's arguments
+COMMANDS = {
+    'next': show_random,
+    'prev': lambda: show_history(-1),
+    'forward': lambda: show_history(1),
+    'earlier': lambda: show_neighbor(later=False),
+    'later': lambda: show_neighbor(later=True),
+    'delete': delete_current,
+    'undo': undo_delete,
+    'sleep': lambda: DISPLAY.sleep_async(),
+    'wake': lambda: DISPLAY.wake_async(post_woke),
+    'format': lambda format=None: change_format(None if format is None else int(format) % 3),
+    'status': status,
+    'stats': lambda: STATS.snapshot() if STATS.enabled else 'error: stats are not enabled',
+}
+
+def run_commands(commands):
+    """Run a batch of control commands, showing the picture they end up on just once.
+
+    Return the reply to each command: its result, or 'ok', or an error message.
+    """
+    global DEFER_SHOW, SHOW_PENDING, PENDING_RANDOM
+    replies = []
+    DEFER_SHOW = True
+    try:
+        for name, *args in commands:
+            if name not in COMMANDS:
+                replies.append(f"error: unknown command {name}")
+                continue
+            try:
+                result = COMMANDS[name](*args)
+            except (TypeError, ValueError) as e:
+                replies.append(f"error: {name}: {e}")
+            except Exception as e:
+                logger.exception(f"Control command {name} failed")
+                replies.append(f"error: {name}: {e!r}")
+            else:
+                replies.append('ok' if result is None else result)
+    finally:
+        DEFER_SHOW = False
+    if SHOW_PENDING and CURRENT_FILENAME is not None:
+        if not show(CURRENT_FILENAME if CURRENT_IMAGE is None else None):
+            post(PICTURE_CHANGE)
+        elif CURRENT_FILENAME == PENDING_RANDOM:
+            mark_seen(PENDING_RANDOM)
+    SHOW_PENDING = False
+    PENDING_RANDOM = None
+    return replies
+
+def submit_commands(commands):
+    """Hand a batch of control commands to the event loop (from the control socket's thread)."""
+    reply = Future()
+    post(CONTROL, commands=commands, reply=reply)
+    return reply
+
+CONTROL_SERVER = None
+if CONTROL_SOCKET:
+    try:
+        CONTROL_SERVER = ControlServer(CONTROL_SOCKET, submit_commands)
+        CONTROL_SERVER.start()
+    except OSError as e:
+        logmsg(f"Could not open control socket {CONTROL_SOCKET}: {e!r}", logging.WARNING)
+        CONTROL_SERVER = None
 
 # Show the first picture after a second
 pygame.time.set_timer(PICTURE_CHANGE, 1000)
@@ -283,96 +473,56 @@ pygame.time.set_timer(SCREEN_SLEEP, next_time(SLEEP))
 pygame.time.set_timer(UPDATE_TIME, next_time())
 
 
+# When we last logged a summary of the stats
+STATS_LOGGED = time.monotonic()
+
 # Handle events
 while True:
     f=pygame.event.wait()
+    handling = time.perf_counter()
+    if STATS.enabled and hasattr(f, 'posted'):
+        STATS.record('queue wait', time.monotonic() - f.posted)
 
     # Show a new random picture
     if (f.type == PICTURE_CHANGE
         or (f.type == pygame.KEYDOWN and f.key in (pygame.K_SPACE, pygame.K_KP_0))
         or (f.type == pygame.MOUSEBUTTONDOWN and f.button == 2)):
+        show_random()
 
-        if DISPLAY.on():
-            if NEXT_RANDOM_FILENAME is None:
-                NEXT_RANDOM_FILENAME = choose_random_pic()
-                NEXT_RANDOM_IMAGE = load(NEXT_RANDOM_FILENAME)
-            PIC_HISTORY.append(NEXT_RANDOM_FILENAME)
-            PIC_HISTORY_INDEX = len(PIC_HISTORY) - 1
-            PICS_SEEN.add(NEXT_RANDOM_FILENAME)
-
-            show((NEXT_RANDOM_FILENAME, NEXT_RANDOM_IMAGE))
-
-            # Update NEXT_FILENAME
-            NEXT_RANDOM_FILENAME = choose_random_pic()
-            NEXT_RANDOM_IMAGE = load(NEXT_RANDOM_FILENAME)
-
-        pygame.time.set_timer(PICTURE_CHANGE,DISPLAY_TIME_MS)
+    # Run commands from the control socket
+    if f.type == CONTROL:
+        replies = ["error: the commands could not be run"] * len(f.commands)
+        try:
+            replies = run_commands(f.commands)
+        finally:
+            # Never leave the client waiting
+            f.reply.set_result(replies)
 
+    # Draw the next frame of a crossfade
+    if f.type == TRANSITION_FRAME:
+        pygame.time.set_timer(TRANSITION_FRAME, RENDERER.transition_step())
 
     # Change the date format
     if (f.type == pygame.KEYDOWN and f.key in (pygame.K_RETURN, pygame.K_KP_ENTER)):
-        FORMAT = (FORMAT+1) % 3
-        show()
+        change_format()
 
     # Show the previous picture in history
     if ((f.type == pygame.KEYDOWN and f.key in (pygame.K_LEFT, pygame.K_KP_4))
         or (f.type == pygame.MOUSEBUTTONDOWN and f.button == 1)):
-        if PIC_HISTORY_INDEX > 0:
-            PIC_HISTORY_INDEX -= 1
-            file = PIC_HISTORY[PIC_HISTORY_INDEX]
-            image = NEXT_IMAGE if NEXT_FILENAME == file else load(file)
-            show((file, image))
-
-            if PIC_HISTORY_INDEX - 1 > 0:
-                NEXT_FILENAME = PIC_HISTORY[PIC_HISTORY_INDEX - 1]
-                NEXT_IMAGE = load(NEXT_FILENAME)
-            pygame.time.set_timer(PICTURE_CHANGE,DISPLAY_TIME_MS)
+        show_history(-1)
 
     # Show the next picture in history
     if ((f.type == pygame.KEYDOWN and f.key in (pygame.K_RIGHT, pygame.K_KP_6))
         or (f.type == pygame.MOUSEBUTTONDOWN and f.button == 3)):
-        if PIC_HISTORY_INDEX < len(PIC_HISTORY) - 1:
-            PIC_HISTORY_INDEX += 1
-            file = PIC_HISTORY[PIC_HISTORY_INDEX]
-            image = NEXT_IMAGE if NEXT_FILENAME == file else load(file)
-                
-            show((file, image))
-
-            if PIC_HISTORY_INDEX + 1 < len(PIC_HISTORY) - 1:
-                NEXT_FILENAME = PIC_HISTORY[PIC_HISTORY_INDEX + 1]
-                NEXT_IMAGE = load(NEXT_FILENAME)
-
-            pygame.time.set_timer(PICTURE_CHANGE,DISPLAY_TIME_MS)
+        show_history(1)
 
     # Show the next picture in sorted order that we haven't seen yet (i.e., chronologically)
-    # Do not put this pic in our history
     if f.type == pygame.KEYDOWN and f.key in (pygame.K_DOWN, pygame.K_KP_2):
-        # Find the place just after where the current pic would have been
-        index = bisect_right(PIC_FILES, CURRENT_FILENAME)
-        if index < len(PIC_FILES):
-            file = PIC_FILES[index]
-            image = NEXT_IMAGE if NEXT_FILENAME == file else load(file)
-            show((file, image))
-            if index + 1 < len(PIC_FILES):
-                NEXT_FILENAME = PIC_FILES[index + 1]
-                NEXT_IMAGE = load(NEXT_FILENAME)
-            pygame.time.set_timer(PICTURE_CHANGE,DISPLAY_TIME_MS)
+        show_neighbor(later=True)
 
     # Show the previous picture in sorted order that we haven't seen yet (i.e., chronologically)
-    # Do not put this pic in our history
     if f.type == pygame.KEYDOWN and f.key in (pygame.K_UP, pygame.K_KP_8):
-        # Find the place in the current pics array where we would have to insert the current pic
-        # The pic we want is just before this.
-        index = bisect_left(PIC_FILES, CURRENT_FILENAME) - 1
-        if index > 0:
-            file = PIC_FILES[index]
-            show((file, load(file)))
-
-            if index - 1 > 0:
-                NEXT_FILENAME = PIC_FILES[index - 1]
-                NEXT_IMAGE = load(NEXT_FILENAME)
-
-            pygame.time.set_timer(PICTURE_CHANGE,DISPLAY_TIME_MS)
+        show_neighbor(later=False)
 
     # Quit the program
     if f.type == pygame.QUIT:
@@ -393,55 +543,80 @@ while True:
 
     # Blank the screen on pressing 'b'
     if (f.type == pygame.KEYDOWN and f.key in (pygame.K_b, pygame.K_KP_MINUS)):
-        DISPLAY.sleep()
+        DISPLAY.sleep_async()
     # Any other key or mouse down makes sure we are awake if we are not
-    elif (f.type == pygame.KEYDOWN or f.type == pygame.MOUSEBUTTONDOWN) and not DISPLAY.on():
-        DISPLAY.wake()
-        show()
-        logmsg(f"Woke, display is now {DISPLAY.on(check=True)}")
+    elif (f.type == pygame.KEYDOWN or f.type == pygame.MOUSEBUTTONDOWN) and not DISPLAY.is_on():
+        DISPLAY.wake_async(post_woke)
 
+    # Mark the file to not be shown
     if (f.type == pygame.KEYDOWN and f.key == pygame.K_DELETE):
-        # Mark the file to not be shown
-        if CURRENT_FILENAME:
-            with open(DELETED_PICS_FILE, 'a') as f:
-                f.write(CURRENT_FILENAME+'\n')
+        delete_current()
 
-            DELETED_PICS.add(CURRENT_FILENAME)
-
-            # also delete from data structures as in line 237
-            day = picday(CURRENT_FILENAME)
-            PIC_GROUPS[day].remove(CURRENT_FILENAME)
-            if len(PIC_GROUPS[day])==0:
-                PIC_DAYS.remove(day)
-                del PIC_GROUPS[day]
+    # Undo the last deletion, showing the picture again
+    if (f.type == pygame.KEYDOWN and f.key == pygame.K_u):
+        undo_delete()
 
     # Wake the screen at the same time every day
     if f.type == SCREEN_WAKE:
-        DISPLAY.wake()
-        show()
+        DISPLAY.wake_async(post_woke)
         # Set a sleep timer for 24 hours from now for the next wake
         pygame.time.set_timer(SCREEN_WAKE, 1000*60*60*24)
-        logmsg(f"Woke, display is now {DISPLAY.on(check=True)}")
+
+    # Once the display is awake, refresh the picture on it
+    if f.type == DISPLAY_WOKE:
+        if CURRENT_FILENAME is not None:
+            show()
+        logmsg(f"Woke, display is now {f.on}")
 
     # Sleep the screen at the same time every day
     if f.type == SCREEN_SLEEP:
-        DISPLAY.sleep()
+        DISPLAY.sleep_async()
         # Set a sleep timer for 24 hours from now for the next sleep
         pygame.time.set_timer(SCREEN_SLEEP, 1000*60*60*24)
+        logmsg(f"Picture cache: {PICTURE_CACHE}")
+        if PIXEL_CACHE is not None:
+            logmsg(f"Pixel cache: {PIXEL_CACHE}")
 
     # Update the time every minute
     if f.type == UPDATE_TIME:
-        # every so often when it is not time-sensitive, do a hard refresh of DISPLAY.on
-        # Refresh the current picture, which will update the time
-        if DISPLAY.on(check=True):
-            show()
-            logmsg("Refreshed time")
+        if STATS.enabled:
+            # How late the timer went off, since it is set for the start of the minute
+            now = datetime.datetime.now()
+            STATS.record('UpdateTime lateness', now.second + now.microsecond / 1e6 if now.second < 30 else 0)
+        # The display state is checked again in the background once it is DISPLAY_STATE_MAX_AGE old
+        # Redraw the time (just the time, the picture is already on the screen)
+        if DISPLAY.is_on():
+            RENDERER.update_clock()
+            logmsg("Refreshed time", logging.DEBUG)
         else:
-            logmsg("skipped time refresh, DISPLAY.on is {DISPLAY.on(check=True)}")
+            logmsg("skipped time refresh, display is off", logging.DEBUG)
+        # Pick up any changes in the pictures directory and save them in the index
+        LIBRARY.refresh()
+        LIBRARY.save_index()
         # Set the next update at the start of the next minute
         nexttime = next_time()
         pygame.time.set_timer(UPDATE_TIME, nexttime)
-        logmsg(f"Set time refresh to {nexttime}")
-
-# Just before exiting, restore the screensaver settings
+        logmsg(f"Set time refresh to {nexttime}", logging.DEBUG)
+
+        if STATS.enabled:
+            STATS.set('cache hit rate', round(PICTURE_CACHE.hits / max(1, PICTURE_CACHE.hits + PICTURE_CACHE.misses), 3))
+            STATS.set('cache', repr(PICTURE_CACHE))
+            if PIXEL_CACHE is not None:
+                STATS.set('pixel cache', repr(PIXEL_CACHE))
+            STATS.write(STATS_FILE)
+            if time.monotonic() - STATS_LOGGED >= STATS_LOG_MINUTES * 60:
+                STATS_LOGGED = time.monotonic()
+                logmsg(STATS.summary())
+
+    if STATS.enabled:
+        STATS.record(EVENT_NAMES.get(f.type) or pygame.event.event_name(f.type), time.perf_counter() - handling)
+
+# Just before exiting, stop decoding pictures, save the index and restore the screensaver settings
+if CONTROL_SERVER is not None:
+    CONTROL_SERVER.close()
+PREFETCHER.close()
+if PIXEL_CACHE is not None:
+    PIXEL_CACHE.close()
+LIBRARY.close()
 DISPLAY.restore()
+LOG_LISTENER.stop()
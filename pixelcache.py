@@ -0,0 +1,150 @@
+"""
+Decoded pictures kept on disk as raw pixels, so showing them again costs a page-in instead of a decode.
+"""
+
+import hashlib
+import mmap
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+import pygame
+
+from atomic import atomic_write
+from cache import LRUCache
+
+# magic, width, height, mtime and size of the picture the pixels were decoded from
+HEADER = struct.Struct('<4sIIdQ')
+MAGIC = b'PIX1'
+
+def pixel_format(screen):
+    """The pygame.image.tobytes()/frombuffer() format closest to the pixel layout of screen.
+
+    Blitting a picture wrapped in the same layout as the screen is a plain copy.
+    """
+    if screen.get_bitsize() == 32 and screen.get_masks()[:3] == (0xff0000, 0xff00, 0xff):
+        return 'BGRA'
+    return 'RGBX'
+
+class PixelCache(LRUCache):
+    """Decoded pictures saved as raw pixel files in directory, up to budget bytes of them.
+
+    ``get()`` memory-maps the file of a picture and wraps it in a surface
+    with pygame.image.frombuffer(), so no decoding (or even reading, until
+    the pixels are blitted) is done. ``put()`` saves a decoded picture on a
+    background thread. Files are keyed by picture name and screen size, and
+    remember the mtime and size of the picture they were decoded from, so a
+    changed picture is decoded again. Once the files are over budget, the
+    least recently used ones are removed. Which were used last is only kept
+    in memory, and saved in ORDER_FILE by ``close()`` so it carries across
+    restarts; files it doesn't know of are newer, by their mtime.
+    """
+
+    ORDER_FILE = 'order.txt'
+
+    def __init__(self, directory, budget, screen_size, format='BGRA'):
+        super().__init__(budget)
+        self.directory = directory
+        self.screen_size = screen_size
+        self.format = format
+        os.makedirs(directory, exist_ok=True)
+        try:
+            with open(os.path.join(directory, self.ORDER_FILE), 'r') as f:
+                order = {name: i for i, name in enumerate(f.read().splitlines())}
+        except OSError:
+            order = {}
+        entries = []
+        with os.scandir(directory) as it:
+            for entry in it:
+                if entry.name.endswith('.raw'):
+                    st = entry.stat()
+                    used = (0, order[entry.name]) if entry.name in order else (1, st.st_mtime)
+                    entries.append((used, entry.name, st.st_size))
+                elif entry.name.endswith('.tmp'):
+                    # Left over from a crash while saving
+                    os.remove(entry.path)
+        for _, name, size in sorted(entries):
+            self._remove(self._put(name, None, size))
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='pixelcache')
+
+    def _name(self, filename):
+        width, height = self.screen_size
+        key = f'{width}x{height} {self.format} {filename}'
+        return hashlib.sha1(key.encode(errors='surrogateescape')).hexdigest() + '.raw'
+
+    def get(self, filename, path):
+        """Return the cached surface of the picture filename (at path), or None."""
+        name = self._name(filename)
+        if not self.touch(name):
+            with self._lock:
+                self.misses += 1
+            return None
+        try:
+            st = os.stat(path)
+            with open(os.path.join(self.directory, name), 'rb') as f:
+                # A private mapping, so nothing we do to the surface can change the file
+                pixels = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        except (OSError, ValueError):
+            self._forget(name)
+            return None
+        if len(pixels) < HEADER.size:
+            self._forget(name)
+            return None
+        magic, width, height, mtime, size = HEADER.unpack_from(pixels)
+        if (magic != MAGIC or mtime != st.st_mtime or size != st.st_size
+                or len(pixels) != HEADER.size + width * height * 4):
+            self._forget(name)
+            return None
+        with self._lock:
+            self.hits += 1
+        image = pygame.image.frombuffer(memoryview(pixels)[HEADER.size:], (width, height), self.format)
+        # The pictures are opaque: blit them without blending
+        image.set_alpha(None)
+        return image
+
+    def put(self, filename, path, image):
+        """Save the decoded picture filename (from path) in the background."""
+        name = self._name(filename)
+        if name in self:
+            return
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+        # Copy the pixels now, so the writer never touches a surface that is in use
+        data = HEADER.pack(MAGIC, image.get_width(), image.get_height(), st.st_mtime, st.st_size)
+        data += pygame.image.tobytes(image, self.format)
+        self._writer.submit(self._write, name, data)
+
+    def _write(self, name, data):
+        try:
+            atomic_write(os.path.join(self.directory, name), data)
+        except OSError:
+            return
+        self._remove(self._put(name, None, len(data)))
+
+    def _remove(self, dropped):
+        """Remove the files of the (name, value) pairs dropped from the cache."""
+        # Surfaces still mapping a removed file keep working
+        for name, _ in dropped:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+    def _forget(self, name):
+        """Drop a file that is missing or out of date."""
+        if self.discard(name):
+            with self._lock:
+                self.misses += 1
+            self._remove([(name, None)])
+
+    def close(self):
+        """Finish saving pictures, and save which were used last."""
+        self._writer.shutdown(wait=True)
+        with self._lock:
+            order = ''.join(name + '\n' for name in self._entries)
+        try:
+            atomic_write(os.path.join(self.directory, self.ORDER_FILE), order)
+        except OSError:
+            pass
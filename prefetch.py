@@ -0,0 +1,62 @@
+"""
+Decode pictures on background threads before they are shown.
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+class Prefetcher:
+    """Load pictures on worker threads into a picture cache.
+
+    ``load`` is the function turning a filename into a decoded image, and
+    ``cache`` is the cache.SurfaceCache decoded images are kept in. Call
+    ``prefetch()`` with the pictures we are likely to show next and ``get()``
+    when a picture is actually needed. ``get()`` returns a cached image
+    immediately, waits for a picture that is already being decoded, and only
+    loads synchronously for a picture nobody asked for ahead of time.
+    """
+
+    def __init__(self, load, cache, workers=2):
+        self._load = load
+        self.cache = cache
+        self._lock = threading.Lock()
+        # filename -> Future for pictures being decoded
+        self._pending = {}
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='prefetch')
+
+    def _decode(self, filename):
+        try:
+            image = self._load(filename)
+            self.cache.put(filename, image)
+            return image
+        finally:
+            with self._lock:
+                self._pending.pop(filename, None)
+
+    def prefetch(self, filenames):
+        """Start decoding filenames (most important first) that are not already cached."""
+        filenames = list(filenames)
+        with self._lock:
+            for filename in filenames:
+                if filename not in self.cache and filename not in self._pending:
+                    self._pending[filename] = self._executor.submit(self._decode, filename)
+        # Keep wanted pictures from being dropped, the most important last
+        for filename in reversed(filenames):
+            self.cache.touch(filename)
+
+    def get(self, filename):
+        """Return the image for filename, loading it if it has not been prefetched."""
+        image = self.cache.get(filename)
+        if image is not None:
+            return image
+        with self._lock:
+            future = self._pending.get(filename)
+        if future is not None:
+            return future.result()
+        image = self._load(filename)
+        self.cache.put(filename, image)
+        return image
+
+    def close(self):
+        """Stop the worker threads, dropping any decodes that have not started."""
+        self._executor.shutdown(wait=False, cancel_futures=True)
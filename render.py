@@ -0,0 +1,167 @@
+"""
+Draw pictures, their caption and the clock on the screen.
+"""
+
+import datetime
+import time
+from collections import OrderedDict
+import pygame
+
+TEXT_COLOR = (255, 255, 255)
+TEXT_BACKGROUND = (0, 0, 0, 100)
+
+def fit(image, size):
+    """Scale image to fit in size (width, height), keeping its aspect ratio.
+
+    This is done once when a picture is loaded, so drawing it is just a blit.
+    """
+    width, height = size
+    scale = min(width / image.get_width(), height / image.get_height())
+    scaled_size = (max(1, round(image.get_width() * scale)), max(1, round(image.get_height() * scale)))
+    if scaled_size == image.get_size():
+        return image
+    # smoothscale only handles 24 and 32 bit surfaces
+    if image.get_bitsize() in (24, 32):
+        return pygame.transform.smoothscale(image, scaled_size)
+    return pygame.transform.scale(image, scaled_size)
+
+class Renderer:
+    """Draw on the screen in layers, redrawing only what changed.
+
+    The picture layer (the picture and its caption) is composed once per
+    picture or caption and kept, so the clock can be redrawn by restoring just
+    the part of the picture layer under it, and only the clock's rectangles are
+    pushed to the display. Rendered text is cached by string.
+
+    Pictures are expected to already fit the screen (see fit()), and are
+    centered on it.
+
+    A new picture can crossfade in from the last one over transition_ms.
+    The fade is drawn a frame at a time by ``transition_step()``, so the
+    caller can handle input between frames. The alpha of each frame follows
+    the time since the fade started, so when frames take longer to draw than
+    1/fps seconds, there are fewer steps but the fade still ends on time.
+    The previous picture layer is kept in a second buffer, so no surfaces are
+    allocated while fading.
+    """
+
+    def __init__(self, screen, font, text_cache_size=64, fps=30):
+        self.screen = screen
+        self.font = font
+        self._text_cache = OrderedDict()
+        self._text_cache_size = text_cache_size
+        self._layer = pygame.Surface(screen.get_size()).convert()
+        self._previous = pygame.Surface(screen.get_size()).convert()
+        self._image = None
+        self._caption = None
+        self._clock = None
+        self._clock_rect = None
+        self.frame_ms = 1000 / fps
+        # A running average of how long a frame of a transition takes to draw
+        self.draw_ms = 0
+        # When the current transition started and how long it takes (in seconds)
+        self._fade_start = None
+        self._fade_seconds = 0
+
+    def text(self, string):
+        """Return the rendered surface for string."""
+        surface = self._text_cache.get(string)
+        if surface is None:
+            surface = self.font.render(string, fgcolor=TEXT_COLOR, bgcolor=TEXT_BACKGROUND)[0]
+            self._text_cache[string] = surface
+            if len(self._text_cache) > self._text_cache_size:
+                self._text_cache.popitem(last=False)
+        else:
+            self._text_cache.move_to_end(string)
+        return surface
+
+    def _compose(self, image, caption):
+        """Draw the picture and caption on the picture layer."""
+        width, height = self._layer.get_size()
+
+        # blank the layer
+        self._layer.fill([0,0,0])
+
+        # Show the image, centered with black bars on the sides or top and bottom
+        offset = (round((width - image.get_width()) / 2), round((height - image.get_height()) / 2))
+        self._layer.blit(image, offset)
+
+        # Put the caption 5 pixels from the bottom of the screen, 10 pixels from left edge
+        words = self.text(caption)
+        self._layer.blit(words, (10, height - words.get_height() - 5))
+
+        self._image = image
+        self._caption = caption
+
+    def _draw_clock(self):
+        """Draw the clock on the screen, returning the rectangle it covers."""
+        width, height = self.screen.get_size()
+        # Time is 5 pixels from bottom, 10 pixels from right edge
+        datetext = self.text(self._clock)
+        return self.screen.blit(datetext, (width - datetext.get_width() - 10, height - datetext.get_height() - 5))
+
+    def show(self, image, caption, transition_ms=0):
+        """Draw the whole screen and push it to the display.
+
+        If transition_ms is given and this is a new picture, start fading it in
+        from the picture on the screen instead, and return the milliseconds until
+        ``transition_step()`` should draw the next frame (0 if there is none).
+        """
+        fade = (transition_ms > 0 and self._image is not None and image is not self._image
+                # Not worth it if we can only draw a couple of frames
+                and transition_ms > 2 * self.draw_ms)
+        if fade:
+            # Keep the picture on the screen as the layer we fade from
+            self._layer, self._previous = self._previous, self._layer
+            self._previous.set_alpha(None)
+            self._compose(image, caption)
+            self._fade_start = time.monotonic()
+            self._fade_seconds = transition_ms / 1000
+            return self.transition_step()
+        self._fade_start = None
+        self._layer.set_alpha(None)
+        if image is not self._image or caption != self._caption:
+            self._compose(image, caption)
+        self.screen.blit(self._layer, (0, 0))
+        self._clock = datetime.datetime.now().strftime("%H:%M")
+        self._clock_rect = self._draw_clock()
+        pygame.display.flip()
+        return 0
+
+    def transition_step(self):
+        """Draw the next frame of the transition.
+
+        Return the milliseconds until the next frame should be drawn, or 0 if the
+        transition is done (or there is none).
+        """
+        if self._fade_start is None:
+            return 0
+        start = time.monotonic()
+        progress = (start - self._fade_start) / self._fade_seconds
+        if progress >= 1:
+            self._fade_start = None
+            self.show(self._image, self._caption)
+            return 0
+        self.screen.blit(self._previous, (0, 0))
+        self._layer.set_alpha(round(255 * progress))
+        self.screen.blit(self._layer, (0, 0))
+        self._clock = datetime.datetime.now().strftime("%H:%M")
+        self._clock_rect = self._draw_clock()
+        pygame.display.flip()
+        draw_ms = (time.monotonic() - start) * 1000
+        self.draw_ms = draw_ms if not self.draw_ms else 0.8 * self.draw_ms + 0.2 * draw_ms
+        # Leave the rest of the frame for handling events, but always at least a millisecond
+        return max(1, round(self.frame_ms - draw_ms))
+
+    def update_clock(self):
+        """Redraw just the clock, if the time shown changed."""
+        clock = datetime.datetime.now().strftime("%H:%M")
+        # A transition draws the clock in every frame anyway
+        if self._image is None or clock == self._clock or self._fade_start is not None:
+            return
+        # Restore the picture under the old clock, then draw the new one
+        old_rect = self._clock_rect
+        self.screen.blit(self._layer, old_rect, old_rect)
+        self._clock = clock
+        self._clock_rect = self._draw_clock()
+        pygame.display.update([old_rect, self._clock_rect])
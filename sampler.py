@@ -0,0 +1,140 @@
+"""
+Weighted random sampling over a set of keys with cheap updates.
+"""
+
+class WeightedSampler:
+    """Sample keys (e.g., days) randomly according to their weights.
+
+    The weights are kept in the leaves of a segment tree whose internal nodes
+    store the sum and the maximum of their children, so drawing a key, changing
+    the weight of a key, and removing a key are all O(log n). Adding a key is
+    O(log n) amortized, reusing the leaves of removed keys. The live keys are
+    also kept in a list with swap-removal so that a uniformly random key can be
+    picked in O(1).
+    """
+
+    def __init__(self, keys=(), weights=()):
+        self._keys = list(keys)
+        self._index = {key: i for i, key in enumerate(self._keys)}
+        weights = list(weights)
+        if len(weights) != len(self._keys):
+            raise ValueError("keys and weights must have the same length")
+
+        size = 1
+        while size < len(self._keys):
+            size *= 2
+        self._size = size
+        self._sum = [0.0] * (2 * size)
+        self._max = [0.0] * (2 * size)
+        self._sum[size:size + len(weights)] = weights
+        self._max[size:size + len(weights)] = weights
+        for i in range(size - 1, 0, -1):
+            self._pull(i)
+
+        # The live keys (by leaf index) and the position of each leaf in that list
+        self._live = list(range(len(self._keys)))
+        self._live_pos = list(range(len(self._keys)))
+        # Leaves of removed keys that can be reused
+        self._free = []
+
+    def _pull(self, i):
+        left, right = 2 * i, 2 * i + 1
+        self._sum[i] = self._sum[left] + self._sum[right]
+        self._max[i] = max(self._max[left], self._max[right])
+
+    def _set_leaf(self, leaf, weight):
+        i = leaf + self._size
+        self._sum[i] = self._max[i] = weight
+        i //= 2
+        while i:
+            self._pull(i)
+            i //= 2
+
+    def __len__(self):
+        return len(self._live)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def keys(self):
+        """Return the keys that are still in the sampler."""
+        return [self._keys[leaf] for leaf in self._live]
+
+    def weight(self, key):
+        return self._sum[self._index[key] + self._size]
+
+    def total(self):
+        """Return the sum of all weights."""
+        return self._sum[1]
+
+    def max(self):
+        """Return the largest weight."""
+        return self._max[1]
+
+    def update(self, key, weight):
+        """Change the weight of key."""
+        self._set_leaf(self._index[key], weight)
+
+    def add(self, key, weight):
+        """Add a new key to the sampler."""
+        if key in self._index:
+            raise KeyError(f"{key!r} is already in the sampler")
+        if self._free:
+            leaf = self._free.pop()
+            self._keys[leaf] = key
+        else:
+            leaf = len(self._keys)
+            if leaf == self._size:
+                self._grow()
+            self._keys.append(key)
+            self._live_pos.append(None)
+        self._index[key] = leaf
+        self._live_pos[leaf] = len(self._live)
+        self._live.append(leaf)
+        self._set_leaf(leaf, weight)
+
+    def _grow(self):
+        """Double the number of leaves, rebuilding the tree."""
+        old_size = self._size
+        leaves = self._sum[old_size:]
+        self._size *= 2
+        self._sum = [0.0] * (2 * self._size)
+        self._max = [0.0] * (2 * self._size)
+        self._sum[self._size:self._size + old_size] = leaves
+        self._max[self._size:self._size + old_size] = leaves
+        for i in range(self._size - 1, 0, -1):
+            self._pull(i)
+
+    def remove(self, key):
+        """Remove key from the sampler."""
+        leaf = self._index.pop(key)
+        self._set_leaf(leaf, 0.0)
+
+        # Swap the leaf with the last live leaf, then drop it
+        pos = self._live_pos[leaf]
+        last = self._live[-1]
+        self._live[pos] = last
+        self._live_pos[last] = pos
+        self._live.pop()
+        self._keys[leaf] = None
+        self._free.append(leaf)
+
+    def sample(self, random):
+        """Return a key picked according to the weights, using the random.Random instance random."""
+        if self.total() <= 0:
+            raise IndexError("cannot sample from an empty sampler")
+        r = random.random() * self.total()
+        i = 1
+        while i < self._size:
+            left = 2 * i
+            # Guard against rounding sending us down a branch with no weight
+            if r < self._sum[left] or self._sum[left + 1] == 0:
+                i = left
+            else:
+                r -= self._sum[left]
+                i = left + 1
+        return self._keys[i - self._size]
+
+    def choice(self, random):
+        """Return a uniformly random key, ignoring the weights."""
+        return self._keys[random.choice(self._live)]
@@ -0,0 +1,114 @@
+"""
+Timings and counts of what the program spends its time on, cheap enough to leave in.
+"""
+
+import json
+import threading
+import time
+from bisect import bisect_left
+
+from atomic import atomic_write
+
+# Histogram bucket upper bounds in seconds: 0.1 ms, 0.2 ms, 0.4 ms, ... up to about 100 s
+BOUNDS = [0.0001 * 2**i for i in range(21)]
+
+class Histogram:
+    """Count durations in buckets that double in size, so percentiles are within a factor of 2."""
+
+    def __init__(self):
+        self.buckets = [0] * (len(BOUNDS) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, seconds):
+        self.buckets[bisect_left(BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, q):
+        """Return the upper bound of the bucket the q-th (0 to 1) duration falls in."""
+        wanted = q * self.count
+        seen = 0
+        for bound, count in zip(BOUNDS, self.buckets):
+            seen += count
+            if seen >= wanted:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0,
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99),
+            'max': self.max,
+        }
+
+
+class Stats:
+    """Timing histograms by name, plus values like cache hit counts.
+
+    ``record()`` and ``set()`` can be called from any thread. When not
+    enabled, they return right away, and ``timed()`` leaves functions as they
+    are, so the instrumentation costs next to nothing.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+        self.histograms = {}
+        self.values = {}
+
+    def record(self, name, seconds):
+        """Add a duration to the histogram name."""
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.add(seconds)
+
+    def set(self, name, value):
+        """Set a value to report along with the timings."""
+        if self.enabled:
+            self.values[name] = value
+
+    def timed(self, name):
+        """A decorator recording how long each call of the function takes in the histogram name."""
+        def decorate(function):
+            if not self.enabled:
+                return function
+            def timed_function(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.record(name, time.perf_counter() - start)
+            return timed_function
+        return decorate
+
+    def snapshot(self):
+        """Return the timings and values as a dict that can be saved as JSON."""
+        with self._lock:
+            timings = {name: histogram.summary() for name, histogram in sorted(self.histograms.items())}
+        return {'seconds': time.monotonic() - self.started, 'timings': timings, 'values': dict(self.values)}
+
+    def summary(self):
+        """Return the timings and values as lines of text for the log."""
+        snapshot = self.snapshot()
+        lines = [f"stats over {snapshot['seconds']/60:.0f} minutes"]
+        for name, t in snapshot['timings'].items():
+            lines.append(f"  {name}: n={t['count']} mean={t['mean']*1e3:.1f} ms p50<={t['p50']*1e3:.1f} ms "
+                         f"p90<={t['p90']*1e3:.1f} ms p99<={t['p99']*1e3:.1f} ms max={t['max']*1e3:.1f} ms")
+        for name, value in sorted(snapshot['values'].items()):
+            lines.append(f"  {name}: {value}")
+        return '\n'.join(lines)
+
+    def write(self, path):
+        """Write the snapshot to path as JSON."""
+        atomic_write(path, json.dumps(self.snapshot(), indent=1))
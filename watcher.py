@@ -0,0 +1,354 @@
+"""
+Keep track of the files in a directory without rescanning it on every change.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+def merge(first, second):
+    """Combine two consecutive sets of (added, removed) changes into one."""
+    added1, removed1 = first
+    added2, removed2 = second
+    return (added1 - removed2) | added2, (removed1 - added2) | removed2
+
+class PollingWatcher:
+    """Track the files in a directory by listing it again whenever its mtime changes.
+
+    ``files`` is the set of filenames in the directory as of the last call to
+    ``changes()``. This is the fallback when inotify is not available.
+
+    If ``files`` is given (e.g., from a saved index), we start from those
+    instead of listing the directory, and list it in a background thread
+    instead. The differences are reported by ``changes()`` once the listing is
+    done.
+    """
+
+    def __init__(self, directory, files=None):
+        self.directory = directory
+        self._mtime = os.path.getmtime(directory)
+        self._lister = None
+        if files is None:
+            self.files = set(os.listdir(directory))
+        else:
+            self.files = set(files)
+            self._listing = None
+            self._lister = threading.Thread(target=self._list_in_background, daemon=True)
+            self._lister.start()
+
+    def _list_in_background(self):
+        self._listing = set(os.listdir(self.directory))
+
+    def _update(self, listing):
+        """Set the files to listing and return the (added, removed) differences."""
+        added = listing - self.files
+        removed = self.files - listing
+        self.files = listing
+        return added, removed
+
+    def _resync(self):
+        """List the directory again and return the (added, removed) differences."""
+        return self._update(set(os.listdir(self.directory)))
+
+    def _listing_pending(self):
+        """Whether the background listing is still running.
+
+        Changes are held back until it is done, since it could still see files
+        as they were before those changes.
+        """
+        return self._lister is not None and self._lister.is_alive()
+
+    def _reconcile(self):
+        """Return the differences found by the background listing once it is done."""
+        if self._lister is None:
+            return set(), set()
+        self._lister = None
+        return self._update(self._listing)
+
+    def changes(self):
+        """Return the sets of (added, removed) filenames since the last call."""
+        if self._listing_pending():
+            return set(), set()
+        reconciled = self._reconcile()
+        mtime = os.path.getmtime(self.directory)
+        if mtime == self._mtime:
+            return reconciled
+        self._mtime = mtime
+        return merge(reconciled, self._resync())
+
+    def state(self):
+        """Return what to start from next time (see ``watch_library()``)."""
+        return sorted(self.files)
+
+    def close(self):
+        return
+
+
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+_EVENT = struct.Struct('iIII')
+
+class InotifyWatcher(PollingWatcher):
+    """Track the files in a directory using Linux inotify events.
+
+    Pictures are counted as added once they are completely written (closed
+    after writing, or moved into the directory), so half-copied files are not
+    picked up. If the kernel event queue overflows we fall back to listing the
+    directory once.
+    """
+
+    def __init__(self, directory, files=None):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE
+        if libc.inotify_add_watch(self._fd, os.fsencode(directory), mask) < 0:
+            err = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(err, f'inotify_add_watch failed for {directory}')
+        # Start watching before listing the directory, so nothing is missed in between
+        super().__init__(directory, files)
+
+    def _read_events(self):
+        """Return all of the queued events as a list of (mask, name) pairs."""
+        events = []
+        while True:
+            try:
+                buffer = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                return events
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            offset = 0
+            while offset < len(buffer):
+                _, mask, _, length = _EVENT.unpack_from(buffer, offset)
+                offset += _EVENT.size
+                name = os.fsdecode(buffer[offset:offset + length].rstrip(b'\0'))
+                offset += length
+                events.append((mask, name))
+
+    def changes(self):
+        """Return the sets of (added, removed) filenames since the last call."""
+        if self._listing_pending():
+            return set(), set()
+        # The events are replayed on top of the listing, whether they came before or after it
+        reconciled = self._reconcile()
+
+        # Last event for a name wins: True if the file is there, False if not
+        present = {}
+        for mask, name in self._read_events():
+            if mask & IN_Q_OVERFLOW:
+                return merge(reconciled, self._resync())
+            if mask & IN_ISDIR:
+                continue
+            present[name] = bool(mask & (IN_CLOSE_WRITE | IN_MOVED_TO))
+
+        added, removed = set(), set()
+        for name, there in present.items():
+            if there and name not in self.files:
+                added.add(name)
+            elif not there and name in self.files:
+                removed.add(name)
+        self.files |= added
+        self.files -= removed
+        return merge(reconciled, (added, removed))
+
+    def close(self):
+        os.close(self._fd)
+
+
+def watch(directory, files=None):
+    """Return a watcher for directory, using inotify if we can.
+
+    If files is given, start from those and check them against the directory in the background.
+    """
+    try:
+        return InotifyWatcher(directory, files)
+    except (OSError, AttributeError, TypeError):
+        return PollingWatcher(directory, files)
+
+
+class ShardedWatcher(PollingWatcher):
+    """Track the files in a directory tree, e.g. pictures sharded into YYYY/MM/ directories.
+
+    Each directory in the tree (a shard) is listed on its own, the shards at
+    each level in parallel, and a shard is only listed again when its mtime
+    changes. ``files`` is the set of paths of the files relative to directory.
+    Hidden directories (like .Trash-1000/) are left out. Since checking means
+    a stat of every shard, ``changes()`` checks at most every min_interval
+    seconds.
+
+    If ``shards`` is given (from ``state()`` saved in an index), we start
+    from those and check the mtime of every shard in the background, listing
+    only the ones that changed.
+    """
+
+    def __init__(self, directory, shards=None, workers=4, min_interval=5):
+        self.directory = directory
+        self.min_interval = min_interval
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='watcher')
+        self._checked = time.monotonic()
+        self._lister = None
+        # shard -> (mtime, names of files, names of subdirectories)
+        self._shards = {}
+        self.files = set()
+        if shards is None:
+            self._update(self._scan())
+        else:
+            self._update({shard: (mtime, set(files), set(subdirs))
+                          for shard, (mtime, files, subdirs) in shards.items()})
+            self._listing = None
+            self._lister = threading.Thread(target=self._list_in_background, daemon=True)
+            self._lister.start()
+
+    def _list_in_background(self):
+        self._listing = self._scan()
+
+    def _check(self, shard):
+        """Return the (mtime, files, subdirectories) of shard, or None if it is gone.
+
+        The shard is only listed if its mtime changed.
+        """
+        path = os.path.join(self.directory, shard)
+        try:
+            mtime = os.stat(path).st_mtime
+            known = self._shards.get(shard)
+            if known is not None and known[0] == mtime:
+                return known
+            files, subdirs = set(), set()
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if not entry.is_dir():
+                        files.add(entry.name)
+                    elif not entry.name.startswith('.'):
+                        subdirs.add(entry.name)
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        return mtime, files, subdirs
+
+    def _scan(self):
+        """Check every shard, level by level, and return them all."""
+        shards = {}
+        level = ['']
+        while level:
+            for shard, listing in zip(level, self._pool.map(self._check, level)):
+                if listing is not None:
+                    shards[shard] = listing
+            level = [os.path.join(shard, subdir) for shard in level if shard in shards
+                     for subdir in shards[shard][2]]
+        return shards
+
+    def _update(self, shards):
+        """Set the shards to shards and return the (added, removed) differences."""
+        added, removed = set(), set()
+        for shard, listing in shards.items():
+            known = self._shards.get(shard)
+            if known is listing:
+                continue
+            files = known[1] if known is not None else set()
+            added.update(os.path.join(shard, name) for name in listing[1] - files)
+            removed.update(os.path.join(shard, name) for name in files - listing[1])
+        for shard in self._shards.keys() - shards.keys():
+            removed.update(os.path.join(shard, name) for name in self._shards[shard][1])
+        self._shards = shards
+        self.files |= added
+        self.files -= removed
+        return added, removed
+
+    def changes(self):
+        """Return the sets of (added, removed) files since the last call."""
+        if self._listing_pending():
+            return set(), set()
+        reconciled = self._reconcile()
+        if time.monotonic() - self._checked < self.min_interval:
+            return reconciled
+        self._checked = time.monotonic()
+        return merge(reconciled, self._update(self._scan()))
+
+    def state(self):
+        return {shard: [mtime, sorted(files), sorted(subdirs)]
+                for shard, (mtime, files, subdirs) in self._shards.items()}
+
+    def close(self):
+        self._pool.shutdown(wait=False)
+
+
+class LibraryWatcher:
+    """Track the files in several directories as one set of files.
+
+    A file is named by its path relative to its directory; if the same name
+    is in more than one directory, the first directory's file is used.
+    """
+
+    def __init__(self, watchers):
+        self.watchers = watchers
+        self.files = set().union(*(watcher.files for watcher in watchers))
+
+    def path(self, name):
+        """Return the full path of the file name."""
+        for watcher in self.watchers:
+            if name in watcher.files:
+                return os.path.join(watcher.directory, name)
+        return os.path.join(self.watchers[0].directory, name)
+
+    def changes(self):
+        """Return the sets of (added, removed) files since the last call."""
+        added, removed = set(), set()
+        for watcher in self.watchers:
+            watcher_added, watcher_removed = watcher.changes()
+            added |= watcher_added
+            removed |= watcher_removed
+        added -= self.files
+        removed = {name for name in removed & self.files
+                   if not any(name in watcher.files for watcher in self.watchers)}
+        self.files |= added
+        self.files -= removed
+        return added, removed
+
+    def state(self):
+        """Return what to start from next time, by directory."""
+        return {watcher.directory: watcher.state() for watcher in self.watchers}
+
+    def close(self):
+        for watcher in self.watchers:
+            watcher.close()
+
+
+def has_subdirectories(directory):
+    """Whether directory has any subdirectories that are not hidden."""
+    with os.scandir(directory) as entries:
+        return any(entry.is_dir() and not entry.name.startswith('.') for entry in entries)
+
+def watch_library(directories, state=None):
+    """Return a watcher for the files in all of directories.
+
+    Directories with subdirectories are watched shard by shard, the others as
+    one flat directory. If state is given (from ``state()`` saved in an
+    index), start from it and check it against the directories in the
+    background.
+    """
+    state = state or {}
+    watchers = []
+    for directory in directories:
+        saved = state.get(directory)
+        if isinstance(saved, dict) or (saved is None and has_subdirectories(directory)):
+            watchers.append(ShardedWatcher(directory, saved))
+        else:
+            watchers.append(watch(directory, saved))
+    return LibraryWatcher(watchers)
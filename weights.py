@@ -0,0 +1,53 @@
+"""
+Seasonal weighting of days by how far their week of the year is from the current week.
+"""
+
+import datetime
+from normdist import NormalDist
+
+# Kernels giving the weight of a week some distance (in weeks) from the current week
+KERNELS = {
+    'normal': NormalDist(0, 1.5).pdf,
+    # Power law fall-off
+    'power': lambda x: (x+1)**-1.5,
+    # Linear fall-off
+    'linear': lambda x: max(1-.2*x, 0),
+}
+
+# pictures without a date are automatically preferred as if they were 4 weeks away
+UNDATED_DISTANCE = 3
+
+def picweek(day):
+    """Return the ISO week of a YYYYMMDD day, or None if the day is not a date."""
+    try:
+        return datetime.date(int(day[:4]), int(day[4:6]), int(day[6:8])).isocalendar()[1]
+    except ValueError:
+        return None
+
+def week_distance(a, b):
+    """Absolute distance between two weeks of the year, wrapping around the year end."""
+    tmp = abs(a - b)
+    return min(tmp, 53-tmp)
+
+class WeekWeights:
+    """A table of kernel weights from every week of the year to every other week.
+
+    The kernel is only evaluated 53*53 times when the table is made, so weighting
+    a day is a lookup: ``weights[current_week][week]``. Weeks are ISO weeks,
+    1 to 53. The week ``None`` (an undated day) gets the undated weight.
+    """
+
+    def __init__(self, kernel='normal'):
+        if isinstance(kernel, str):
+            kernel = KERNELS[kernel]
+        normalization = kernel(0)
+        self.undated = kernel(UNDATED_DISTANCE)/normalization
+        self._rows = {}
+        for current in range(1, 54):
+            row = {week: kernel(week_distance(current, week))/normalization for week in range(1, 54)}
+            row[None] = self.undated
+            self._rows[current] = row
+
+    def __getitem__(self, current_week):
+        """Return a mapping from each week (or None) to its weight in current_week."""
+        return self._rows[current_week]